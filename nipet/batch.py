@@ -0,0 +1,271 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Run Logan DVR for many subjects in parallel worker processes
+
+A manifest is a csv file with one subject per row and the columns
+
+    subject, frames, refroi, mask, timing
+
+and optionally aparc, outdir and units. frames is a glob pattern
+matching the 3D frames (or a single 4D file), timing is a timing
+file read with frametime.FrameTime.from_csv.
+
+    python -m nipet.batch manifest.csv --nprocs 8 --memory 32000
+"""
+import os
+import csv
+import time
+import argparse
+import traceback
+import multiprocessing
+from glob import glob
+import numpy as np
+import nibabel as ni
+from . import ga
+from . import frametime
+from . import instrument
+
+SUMMARY_FIELDS = ['subject', 'status', 'seconds', 'dvr',
+                  'pibindex', 'memory_estimate', 'error']
+
+
+def read_manifest(manifest):
+    """reads csv manifest into a list of dicts, one per subject"""
+    with open(manifest) as infile:
+        # optional columns left off a row are None
+        subjects = [dict((key.strip(), (val or '').strip())
+                         for key, val in row.items() if key is not None)
+                    for row in csv.DictReader(infile)]
+    required = ['subject', 'frames', 'refroi', 'mask', 'timing']
+    for row in subjects:
+        missing = [key for key in required if not row.get(key)]
+        if missing:
+            raise IOError('%s: subject %s missing %s'%(manifest,
+                                                       row.get('subject'),
+                                                       missing))
+    return subjects
+
+
+def find_frames(pattern):
+    """returns sorted list of frames matching pattern, or the filename
+    if it matches a single 4D file"""
+    frames = sorted(glob(pattern))
+    if not frames:
+        raise IOError('no frames found for %s'%pattern)
+    if len(frames) == 1 and len(ni.load(frames[0]).shape) == 4:
+        return frames[0]
+    return frames
+
+
+def estimate_memory(subject, itemsize=8):
+    """ estimate of peak memory (bytes) used by run_subject, from
+    the image headers only (no data is read), itemsize is 4 for
+    float32 data"""
+    frames = find_frames(subject['frames'])
+    if ga.is_iterable(frames):
+        nframes = len(frames)
+    else:
+        nframes = ni.load(frames).shape[-1]
+    shape = ni.load(subject['mask']).shape
+    nvox = 1
+    for dim in shape[:3]:
+        nvox *= dim
+    # full 4D data plus masked data and its working arrays, worst case
+    # of every voxel in the mask
+    return nvox * nframes * itemsize * (1 + 1 + ga.BLOCK_ARRAYS)
+
+
+def run_subject(subject, k2ref=.15, range=(35,90), dtype=None):
+    """ get_ref -> mask_data -> calc_xy -> calc_ki -> save_data2nii
+    for one subject (dict with manifest fields)
+    returns dict with outputs
+    dtype np.float32 runs the pipeline in float32 (see ga.FLOAT32_RTOL)
+    with instrumentation enabled, the stages are recorded
+    with the subject (see instrument)"""
+    previous = instrument.get_subject()
+    instrument.set_subject(subject['subject'])
+    try:
+        with instrument.stage('run_subject'):
+            return _run_subject(subject, k2ref=k2ref, range=range,
+                                dtype=dtype)
+    finally:
+        instrument.set_subject(previous)
+
+
+def _run_subject(subject, k2ref=.15, range=(35,90), dtype=None):
+    """the stages of run_subject"""
+    outdir = subject.get('outdir') or os.path.dirname(
+        os.path.abspath(subject['mask']))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    units = subject.get('units') or None
+    timing = frametime.FrameTime().from_csv(subject['timing'], units=units)
+    midtimes = timing.get_midtimes('sec')[:, 1]
+    data4d = ga.get_data_nibabel(find_frames(subject['frames']), dtype=dtype)
+    ref = ga.get_ref(subject['refroi'], data4d)
+    masked_data, mask_roi = ga.mask_data(subject['mask'], data4d,
+                                         dtype=dtype)
+    x, y = ga.calc_xy(ref, masked_data, midtimes, k2ref=k2ref)
+    del masked_data
+    allki, allvd, residuals = ga.calc_ki(x, y, timing, range=range)
+    del x, y
+    dvrfile = ga.save_data2nii(allki, subject['mask'],
+                               filename='%s_DVR'%subject['subject'],
+                               outdir=outdir, index=mask_roi)
+    result = {'dvr': dvrfile}
+    if subject.get('aparc'):
+        region = ga.get_labelroi_data(data4d, subject['aparc'],
+                                      ga.PIB_INDEX_LABELS)
+        rx, ry = ga.region_xy(ref, region, midtimes, k2ref=k2ref)
+        result['pibindex'] = ga.calc_ki(rx, ry, timing, range=range)[0]
+    return result
+
+
+def _run_subject_status(args):
+    """ runs run_subject in a worker, never raises,
+    returns summary row for subject"""
+    subject, k2ref, range, dtype, memory_estimate = args
+    status = dict(subject=subject['subject'],
+                  memory_estimate=memory_estimate)
+    start = time.time()
+    try:
+        status.update(run_subject(subject, k2ref=k2ref, range=range,
+                                  dtype=dtype))
+        status['status'] = 'ok'
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc().strip().splitlines()[-1]
+    status['seconds'] = '%0.2f'%(time.time() - start)
+    return status
+
+
+def write_summary(statuses, outfile):
+    """writes per-subject status rows to csv outfile"""
+    with open(outfile, 'wb') as out:
+        writer = csv.DictWriter(out, SUMMARY_FIELDS, restval='')
+        writer.writeheader()
+        for status in statuses:
+            writer.writerow(status)
+    return outfile
+
+
+def run_batch(manifest, nprocs=None, memory_limit=None, k2ref=.15,
+              range=(35,90), summary=None, log=None, dtype=None):
+    """ runs run_subject for every subject in manifest in a pool of
+    worker processes
+
+    Parameters
+    ----------
+    manifest : str or list
+        csv manifest file, or list of subject dicts (see read_manifest)
+    nprocs : int
+        maximum number of worker processes (default: number of cpus)
+    memory_limit : int
+        bytes available to all workers, concurrency is capped so that
+        workers each running the largest subject (see estimate_memory)
+        fit within it
+    k2ref : float
+        k2 of reference region
+    range : tuple
+        range of steady state data (in minutes)
+    summary : str
+        csv file to write per-subject status and timing to
+    log : str
+        json lines file to append per-stage timing and memory
+        records of every subject to (see instrument)
+    dtype : numpy dtype
+        np.float32 runs subjects in float32, halving their memory
+
+    Returns
+    -------
+    statuses : list of dicts
+        one per subject, in manifest order
+    """
+    if not ga.is_iterable(manifest):
+        subjects = read_manifest(manifest)
+    else:
+        subjects = list(manifest)
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    estimates = []
+    for subject in subjects:
+        try:
+            estimates.append(estimate_memory(
+                subject, np.dtype(dtype or np.float64).itemsize))
+        except Exception:
+            # run_subject will report the problem
+            estimates.append(0)
+    nworkers = max(1, min(nprocs, len(subjects)))
+    if memory_limit is not None and max(estimates + [0]) > 0:
+        nworkers = max(1, min(nworkers,
+                              int(memory_limit // max(estimates))))
+    jobs = [(subject, k2ref, range, dtype, estimate)
+            for subject, estimate in zip(subjects, estimates)]
+    handlers = []
+    if log is not None:
+        # workers are forked with the log open
+        handlers = instrument.enable(logfile=log)
+    try:
+        statuses = _run_jobs(jobs, nworkers)
+    finally:
+        for handler in handlers:
+            instrument.disable(handler)
+    if summary is not None:
+        write_summary(statuses, summary)
+    return statuses
+
+
+def _run_jobs(jobs, nworkers):
+    """runs _run_subject_status for jobs in nworkers processes"""
+    if nworkers == 1:
+        statuses = map(_run_subject_status, jobs)
+    else:
+        # one subject per task, a fresh worker for each keeps memory
+        # from one subject out of the next
+        pool = multiprocessing.Pool(nworkers, maxtasksperchild=1)
+        try:
+            statuses = pool.map(_run_subject_status, jobs, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('manifest', help='subject manifest csv')
+    parser.add_argument('--nprocs', type=int, default=None,
+                        help='maximum worker processes')
+    parser.add_argument('--memory', type=float, default=None,
+                        help='memory (MB) available to all workers')
+    parser.add_argument('--k2ref', type=float, default=.15)
+    parser.add_argument('--range', type=float, nargs=2, default=(35, 90),
+                        help='steady state range (minutes)')
+    parser.add_argument('--summary', default='batch_summary_%s.csv'%(
+        time.strftime('%Y-%m-%d-%H-%M')))
+    parser.add_argument('--float32', action='store_true',
+                        help='compute in float32 (half the memory)')
+    parser.add_argument('--log', default=None,
+                        help='json lines file of stage timing and memory')
+    args = parser.parse_args(argv)
+    memory_limit = None
+    if args.memory is not None:
+        memory_limit = args.memory * 1024 ** 2
+    statuses = run_batch(args.manifest, nprocs=args.nprocs,
+                         memory_limit=memory_limit, k2ref=args.k2ref,
+                         range=tuple(args.range), summary=args.summary,
+                         log=args.log,
+                         dtype=np.float32 if args.float32 else None)
+    failed = [status for status in statuses if status['status'] != 'ok']
+    print '%d subjects, %d failed, summary: %s'%(len(statuses),
+                                                 len(failed), args.summary)
+    return len(failed)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
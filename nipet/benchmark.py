@@ -0,0 +1,337 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark the voxelwise Logan pipeline on synthetic 4D PET phantoms
+
+A phantom has a reference TAC sampled at the frame midtimes, and
+every brain voxel has a TAC whose Logan plot, as computed by ga
+(trapezoid integration on midtimes), is exactly a line of slope DVR,
+so the fitted DVR map can be checked against the known one.
+The pipeline stages
+
+    get_ref, mask_data, calc_xy, calc_ki, results_to_array, save_data2nii
+
+are timed and their peak memory (resident set size) recorded, results
+are written to a json file, which can be compared with a baseline
+
+    python -m nipet.benchmark run --sizes small large --out bench.json
+    python -m nipet.benchmark compare bench.json baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import nibabel as ni
+from . import ga
+from . import frametime
+from . import instrument
+
+# phantom image shapes, frames follow PIB_DURATIONS
+SIZES = {'tiny': (16, 16, 16),
+         'small': (91, 109, 91),
+         'large': (256, 256, 207)}
+# frame durations (sec) of the 34 frame PIB protocol
+PIB_DURATIONS = [15] * 4 + [30] * 8 + [60] * 9 + [180] * 2 + \
+                [300] * 10 + [600]
+STAGES = ['get_data_nibabel', 'get_ref', 'mask_data', 'calc_xy',
+          'calc_ki', 'results_to_array', 'save_data2nii']
+# compare flags a stage slower (or larger) than baseline by more than
+# the tolerance (fraction) and the minimum absolute change
+TIME_TOLERANCE = 0.2
+MIN_SECONDS = 0.05
+MEMORY_TOLERANCE = 0.2
+MIN_MEMORY = 16 * 1024 ** 2
+
+
+def pib_timing(durations=PIB_DURATIONS):
+    """frametime.FrameTime (sec) of contiguous frames of durations"""
+    durations = np.asarray(durations, dtype=float)
+    stops = durations.cumsum()
+    data = np.column_stack([np.arange(1, durations.size + 1),
+                            stops - durations, stops, durations])
+    return frametime.FrameTime().from_array(data, 'sec')
+
+
+def reference_tac(midtimes):
+    """ smooth reference TAC (bq/ml), a gamma variate of the midtimes
+    (sec), rising to a peak at 2 minutes and washing out"""
+    minutes = np.asarray(midtimes) / 60.
+    return 1000. * minutes * np.exp(1 - minutes / 2.) / 2. + 50.
+
+
+def unit_tac(ref, midtimes, k2ref=.15, tau=10.):
+    """ TAC of a voxel with DVR 1 whose Logan plot is exactly linear
+
+    With I the integral of the voxel TAC C (see ga.integrate_reference)
+    and int_ref the integral of the reference, solving
+
+        I + tau * C = DVR * (int_ref + ref / k2ref)
+
+    gives int(C) / C = DVR * (int_ref + ref / k2ref) / C - tau
+    the solution is linear in DVR, so a voxel with any DVR has
+    TAC DVR * unit_tac"""
+    operator = ga.integration_operator(midtimes)
+    target = ga.integrate_reference(ref, midtimes) + ref / k2ref
+    return np.linalg.solve(operator + tau * np.eye(ref.size), target)
+
+
+def make_phantom(outdir, shape, timing, k2ref=.15, dtype=np.float32):
+    """ writes a phantom (4D data, mask and reference region) to outdir
+
+    The brain is an ellipsoid filling most of the image, with a
+    reference region near its base whose voxels all have the reference
+    TAC, the other brain voxels (the mask) have DVR between 1 and 2
+    varying smoothly across the image
+
+    Returns
+    -------
+    files : dict
+        data, mask and refroi nifti files
+    dvr : numpy array
+        3D map of true DVR, 0 outside the mask
+    """
+    midtimes = timing.get_midtimes('sec')[:, 1]
+    ref = reference_tac(midtimes)
+    tac = unit_tac(ref, midtimes, k2ref)
+    grid = np.ogrid[tuple(slice(0, dim) for dim in shape)]
+    coords = [(axis + 0.5) / dim * 2 - 1 for axis, dim in zip(grid, shape)]
+    radius = sum(coord ** 2 for coord in coords)
+    brain = radius < 0.9 ** 2
+    refroi = np.logical_and(brain, (coords[0] ** 2 + coords[1] ** 2 +
+                                    (coords[2] + 0.6) ** 2) < 0.25 ** 2)
+    mask = np.logical_and(brain, ~refroi)
+    dvr = 1.5 + 0.5 * (np.sin(np.pi * coords[0]) * np.cos(np.pi * coords[1])
+                       * np.cos(np.pi * coords[2] / 2))
+    dvr = np.where(mask, dvr, 0.)
+    data = np.zeros(shape + (midtimes.size,), dtype=dtype)
+    for frame in xrange(midtimes.size):
+        data[..., frame] = dvr * tac[frame] + refroi * ref[frame]
+    affine = np.diag([2., 2., 2., 1.])
+    files = dict(data=os.path.join(outdir, 'phantom_data.nii'),
+                 mask=os.path.join(outdir, 'phantom_mask.nii'),
+                 refroi=os.path.join(outdir, 'phantom_ref.nii'))
+    ni.Nifti1Image(data, affine).to_filename(files['data'])
+    del data
+    ni.Nifti1Image(mask.astype(np.uint8), affine).to_filename(files['mask'])
+    ni.Nifti1Image(refroi.astype(np.uint8),
+                   affine).to_filename(files['refroi'])
+    return files, dvr
+
+
+def measure(func, *args, **kwargs):
+    """ calls func(*args, **kwargs), returns its result and a dict
+    of seconds, peak_rss (bytes) during the call and rss_increase
+    (peak_rss less resident size at the start)"""
+    instrument.reset_peak_rss()
+    start_rss = instrument.current_rss()
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    peak = instrument.peak_rss()
+    return result, dict(seconds=seconds, peak_rss=peak,
+                        rss_increase=max(0, peak - start_rss))
+
+
+def run_pipeline(files, timing, outdir, k2ref=.15, range=(35,90),
+                 dtype=None):
+    """ runs the Logan pipeline stages (STAGES) on files (see
+    make_phantom), in dtype (eg np.float32) if given, returns the
+    DVR map and a dict of stage measurements (see measure)"""
+    midtimes = timing.get_midtimes('sec')[:, 1]
+    stages = {}
+    data4d, stages['get_data_nibabel'] = measure(ga.get_data_nibabel,
+                                                 files['data'], dtype=dtype)
+    ref, stages['get_ref'] = measure(ga.get_ref, files['refroi'], data4d)
+    (masked, index), stages['mask_data'] = measure(ga.mask_data,
+                                                   files['mask'], data4d,
+                                                   dtype=dtype)
+    (x, y), stages['calc_xy'] = measure(ga.calc_xy, ref, masked, midtimes,
+                                        k2ref=k2ref)
+    del masked
+    (dvr, vd, resid), stages['calc_ki'] = measure(ga.calc_ki, x, y, timing,
+                                                  range=range)
+    del x, y
+    shape = data4d.shape[:-1]
+    dvrmap, stages['results_to_array'] = measure(ga.results_to_array, dvr,
+                                                 index, shape=shape)
+    outfile, stages['save_data2nii'] = measure(ga.save_data2nii, dvrmap,
+                                               files['mask'],
+                                               filename='phantom_DVR',
+                                               outdir=outdir)
+    os.remove(outfile)
+    return dvrmap, stages
+
+
+def benchmark_size(name, shape=None, nframes=34, repeat=3, k2ref=.15,
+                   tmpdir=None, dtype=None):
+    """ makes a phantom of shape (default SIZES[name]) with the first
+    nframes frames of the PIB protocol and runs the pipeline repeat
+    times, in dtype if given (see run_pipeline)
+
+    Returns
+    -------
+    result : dict
+        shape, nframes, nvoxels, dvr_error (largest absolute error of
+        the fitted DVR) and stages, for each stage the smallest
+        seconds and largest peak_rss and rss_increase of the repeats
+    """
+    if shape is None:
+        shape = SIZES[name]
+    shape = tuple(shape)
+    timing = pib_timing(PIB_DURATIONS[:nframes])
+    outdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        files, truth = make_phantom(outdir, shape, timing, k2ref=k2ref)
+        stages = dict((stage, dict(seconds=[], peak_rss=[],
+                                   rss_increase=[])) for stage in STAGES)
+        for run in xrange(repeat):
+            dvr, measured = run_pipeline(files, timing, outdir, k2ref=k2ref,
+                                         dtype=dtype)
+            for stage in STAGES:
+                for key, value in measured[stage].items():
+                    stages[stage][key].append(value)
+    finally:
+        shutil.rmtree(outdir)
+    mask = truth > 0
+    for stage in STAGES:
+        stages[stage] = dict(seconds=min(stages[stage]['seconds']),
+                             peak_rss=max(stages[stage]['peak_rss']),
+                             rss_increase=max(stages[stage]['rss_increase']))
+    return dict(shape=list(shape), nframes=nframes,
+                nvoxels=int(mask.sum()),
+                dvr_error=float(np.abs(dvr[mask] - truth[mask]).max()),
+                stages=stages)
+
+
+def run(sizes=('small',), nframes=34, repeat=3, outfile=None, tmpdir=None,
+        dtype=None):
+    """ benchmarks each of sizes (names in SIZES), returns results dict,
+    written as json to outfile if given"""
+    results = dict(created=time.strftime('%Y-%m-%d-%H-%M-%S'),
+                   python=platform.python_version(),
+                   numpy=np.__version__,
+                   nibabel=ni.__version__,
+                   machine=platform.platform(),
+                   repeat=repeat,
+                   dtype=np.dtype(dtype or np.float64).name,
+                   sizes={})
+    for name in sizes:
+        results['sizes'][name] = benchmark_size(name, nframes=nframes,
+                                                repeat=repeat, tmpdir=tmpdir,
+                                                dtype=dtype)
+    if outfile is not None:
+        with open(outfile, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    return results
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+            memory_tolerance=MEMORY_TOLERANCE):
+    """ compares results with baseline (dicts as returned by run, or
+    json files), sizes and stages in both are compared
+
+    Returns
+    -------
+    regressions : list of dicts
+        size, stage, metric (seconds or peak_rss), baseline, current
+        and ratio for each stage slower or larger than baseline by
+        more than the tolerance (and MIN_SECONDS or MIN_MEMORY)
+    """
+    if isinstance(results, basestring):
+        with open(results) as infile:
+            results = json.load(infile)
+    if isinstance(baseline, basestring):
+        with open(baseline) as infile:
+            baseline = json.load(infile)
+    limits = dict(seconds=(time_tolerance, MIN_SECONDS),
+                  peak_rss=(memory_tolerance, MIN_MEMORY))
+    regressions = []
+    for name in sorted(results['sizes']):
+        if name not in baseline['sizes']:
+            continue
+        current = results['sizes'][name]['stages']
+        base = baseline['sizes'][name]['stages']
+        for stage in STAGES:
+            if stage not in current or stage not in base:
+                continue
+            for metric, (tolerance, minimum) in sorted(limits.items()):
+                old = base[stage][metric]
+                new = current[stage][metric]
+                if new > old * (1 + tolerance) and new - old > minimum:
+                    regressions.append(dict(size=name, stage=stage,
+                                            metric=metric, baseline=old,
+                                            current=new,
+                                            ratio=new / float(old or 1)))
+    return regressions
+
+
+def report(results):
+    """table of stage seconds and peak memory (MB) for each size"""
+    lines = []
+    for name in sorted(results['sizes']):
+        size = results['sizes'][name]
+        lines.append('%s %s x %d frames, %d voxels, DVR error %g'%(
+            name, size['shape'], size['nframes'], size['nvoxels'],
+            size['dvr_error']))
+        for stage in STAGES:
+            measured = size['stages'][stage]
+            lines.append('    %-18s %9.3f s %9.1f MB'%(
+                stage, measured['seconds'],
+                measured['peak_rss'] / 1024. ** 2))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    runner = commands.add_parser('run', help='run benchmarks')
+    runner.add_argument('--sizes', nargs='+', default=['small'],
+                        choices=sorted(SIZES))
+    runner.add_argument('--nframes', type=int, default=34)
+    runner.add_argument('--repeat', type=int, default=3)
+    runner.add_argument('--out', default='benchmark_%s.json'%(
+        time.strftime('%Y-%m-%d-%H-%M')))
+    runner.add_argument('--baseline', default=None,
+                        help='json results to compare with')
+    runner.add_argument('--tmpdir', default=None,
+                        help='directory for phantom files')
+    runner.add_argument('--float32', action='store_true',
+                        help='run the pipeline in float32')
+    comparer = commands.add_parser('compare',
+                                   help='compare results with a baseline')
+    comparer.add_argument('results')
+    comparer.add_argument('baseline')
+    for command in [runner, comparer]:
+        command.add_argument('--time-tolerance', type=float,
+                             default=TIME_TOLERANCE)
+        command.add_argument('--memory-tolerance', type=float,
+                             default=MEMORY_TOLERANCE)
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run(args.sizes, nframes=args.nframes, repeat=args.repeat,
+                      outfile=args.out, tmpdir=args.tmpdir,
+                      dtype=np.float32 if args.float32 else None)
+        print report(results)
+        print 'results: %s'%args.out
+        baseline = args.baseline
+    else:
+        results = args.results
+        baseline = args.baseline
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline,
+                          time_tolerance=args.time_tolerance,
+                          memory_tolerance=args.memory_tolerance)
+    for item in regressions:
+        print 'REGRESSION %(size)s %(stage)s %(metric)s: ' \
+              '%(baseline)s -> %(current)s (x%(ratio)0.2f)'%item
+    return len(regressions)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,17 @@
 import numpy as np
 import csv
 from pandas import ExcelFile, read_csv, DataFrame
-from os.path import exists, splitext
+from os.path import exists, splitext, isdir, join
+from glob import glob
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import logging
 from datetime import datetime 
 archive_exts = ['gz']
+# threads reading ecat files in FrameTime.from_ecats
+ECAT_THREADS = 8
 from nibabel import ecat
+import instrument
 
 
 def _min_to_sec(minutes):
@@ -59,11 +65,215 @@ class DataError(Exception):
     def __str__(self):
         return repr(self.msg) + ' from ' + repr(self.source) + ': ' + repr(self.data)
 
-class FrameTime:
+FRAME_PROBLEMS = ['columns', 'incomplete', 'negative', 'nonconsecutive',
+                  'missing', 'overlapping', 'unaligned', 'swapped']
+
+def validate_frames(data, eps=1e-4, start=1, stop=2, duration=3):
+    """
+    Checks every frame of a timing array at once and reports all
+    problems found, rather than stopping at the first.
+
+    Parameters
+    ----------
+        data:
+            timing array (number of frames X 4)
+        eps:
+            tolerance for duration == stop_time - start_time
+        start, stop, duration:
+            columns of data holding start, stop time and duration
+
+    Returns
+    -------
+        problems: dict
+            'valid' is True if no problems were found,
+            'nframes' the number of rows, and one list per problem
+            (see FRAME_PROBLEMS):
+            columns        - shape of data, if it is not (nframes, 4)
+            missing        - frame numbers absent from 1..last frame
+            incomplete, negative, nonconsecutive, overlapping,
+            unaligned, swapped
+                           - row indices (0 based) of frames with nan
+                             entries, negative frame number, frame
+                             number not above the previous one (or a
+                             first frame number other than 1), start
+                             before the previous stop, duration not
+                             stop - start, and stop and duration
+                             columns switched
+    """
+    problems = dict((key, []) for key in FRAME_PROBLEMS)
+    data = np.asarray(data, dtype=float)
+    problems['nframes'] = data.shape[0] if data.ndim else 0
+    if data.ndim != 2 or data.shape[1] != 4:
+        problems['columns'] = list(data.shape)
+        problems['valid'] = False
+        return problems
+    numbers = data[:, 0]
+    rows = np.arange(data.shape[0])
+    # nan entries are reported as incomplete, not compared
+    with np.errstate(invalid='ignore'):
+        incomplete = np.isnan(data).any(axis=1)
+        problems['incomplete'] = rows[incomplete].tolist()
+        problems['negative'] = rows[numbers < 0].tolist()
+        # frame numbers start at 1
+        first = (numbers[:1] != 1) & ~np.isnan(numbers[:1])
+        nonconsecutive = np.concatenate([first, np.diff(numbers) <= 0])
+        problems['nonconsecutive'] = rows[nonconsecutive].tolist()
+        numbers = numbers[~np.isnan(numbers)]
+        if numbers.size:
+            expected = np.arange(1, int(numbers.max()) + 1)
+            problems['missing'] = np.setdiff1d(expected, numbers).tolist()
+        previous_stop = np.concatenate([[0], data[:-1, stop]])
+        problems['overlapping'] = rows[data[:, start] < previous_stop].tolist()
+        unaligned = np.abs(data[:, duration] -
+                           (data[:, stop] - data[:, start])) > eps
+        # stop time in the duration column and vice versa
+        switched = np.abs(data[:, stop] -
+                          (data[:, duration] - data[:, start])) <= eps
+        swapped = unaligned & switched
+        problems['unaligned'] = rows[unaligned & ~swapped].tolist()
+        problems['swapped'] = rows[swapped].tolist()
+    problems['valid'] = not any(problems[key] for key in FRAME_PROBLEMS)
+    return problems
+
+def describe_problems(problems):
+    """one line description of the problems found by validate_frames"""
+    return '; '.join('%s %s'%(key, problems[key])
+                     for key in FRAME_PROBLEMS if problems[key])
+
+def _to_float(field):
+    """float of a table field, nan if it is blank or not a number"""
+    try:
+        return float(field)
+    except ValueError:
+        return np.nan
+
+def _sniff_delimiter(line):
+    """delimiter of a timing table line, None for whitespace"""
+    for delimiter in [',', '\t', ';']:
+        if delimiter in line:
+            return delimiter
+    return None
+
+@instrument.instrumented()
+def read_timing_table(timing_file, correct=True, eps=1e-4):
+    """
+    Reads a timing table (frame_number, start_time, stop_time, duration)
+    in one pass: the file is read once, a header line and the delimiter
+    (comma, tab, semicolon or whitespace) are detected from the first
+    lines, blank lines are skipped and any line ending is accepted.
+    Fields that are blank or not numbers are read as nan.
+
+    Parameters
+    ----------
+        timing_file:
+            the name of the file e.g. 'filename.csv'
+        correct:
+            if True, switch stop and duration columns when most
+            frames have the stop time in the last column, and drop
+            frames with missing entries
+        eps:
+            tolerance for duration == stop_time - start_time when
+            deciding the column order
+
+    Returns
+    -------
+        data: numpy array
+            (number of frames X 4) float array
+    """
+    with open(timing_file, 'rb') as infile:
+        lines = [line.strip() for line in infile.read().splitlines()]
+    lines = [line for line in lines if line]
+    if lines and not lines[0][0].isdigit():
+        lines = lines[1:]
+    if not lines:
+        raise IOError('no frames in %s'%timing_file)
+    delimiter = _sniff_delimiter(lines[0])
+    rows = []
+    for line in lines:
+        fields = [_to_float(field) for field in line.split(delimiter)[:4]]
+        rows.append(fields + [np.nan] * (4 - len(fields)))
+    data = np.array(rows)
+    if correct:
+        data = data[~np.isnan(data).any(axis=1)]
+        # stop = start + duration holds for one order of the columns
+        with np.errstate(invalid='ignore'):
+            in_order = np.abs(data[:, 2] - data[:, 1] - data[:, 3]) <= eps
+            switched = np.abs(data[:, 3] - data[:, 1] - data[:, 2]) <= eps
+        if np.sum(switched & ~in_order) > np.sum(in_order & ~switched):
+            data = data[:, [0, 1, 3, 2]]
+    return data
+
+def read_ecat_timing(ecat_file):
+    """
+    Reads frame timing of ecat_file, opening it once and reading only
+    the main header, matrix list and frame subheaders
+
+    Returns
+    -------
+        num_frames: int
+            number of frames in the series (from the main header)
+        timing: numpy array
+            (frames in file X 4) frame number in series, start time,
+            stop time and duration in seconds
+    """
+    with open(ecat_file, 'rb') as fileobj:
+        hdr = ecat.EcatHeader.from_fileobj(fileobj)
+        mlist = ecat.read_mlist(fileobj, hdr.endianness)
+        subheaders = ecat.read_subheaders(fileobj, mlist, hdr.endianness)
+    framenumbers = ecat.get_series_framenumbers(mlist)
+    timing = np.zeros((len(subheaders), 4))
+    for stored, shdr in enumerate(subheaders):
+        start = shdr['frame_start_time'] / 1000
+        duration = shdr['frame_duration'] / 1000
+        timing[stored] = [framenumbers[stored], start, start + duration,
+                          duration]
+    return int(hdr['num_frames']), timing
+
+@instrument.instrumented()
+def read_timing_dir(timing_files, pattern='*.csv', correct=True):
+    """
+    Reads many timing tables (see read_timing_table) into one array
+
+    Parameters
+    ----------
+        timing_files:
+            directory (files matching pattern are used),
+            or list of timing files
+        pattern:
+            glob pattern of timing files in a directory
+        correct:
+            passed to read_timing_table
+
+    Returns
+    -------
+        data: numpy array
+            (total number of frames X 4) frames of all files
+        offsets: numpy array
+            (number of files + 1), frames of file i are
+            data[offsets[i]:offsets[i + 1]]
+        files: list
+            files read, in order
+    """
+    if isinstance(timing_files, basestring):
+        timing_files = sorted(glob(join(timing_files, pattern)))
+    tables = [read_timing_table(timing_file, correct)
+              for timing_file in timing_files]
+    offsets = np.cumsum([0] + [table.shape[0] for table in tables])
+    if tables:
+        data = np.concatenate(tables)
+    else:
+        data = np.zeros((0, 4))
+    return data, offsets, list(timing_files)
+
+class FrameTime(object):
     """
     Reads or generates timing file for use with graphical analysis.
     Format (number of frames X 4):
         frame_number, start_time, duration, stop_time    
+
+    Unit conversions and start, stop and mid times are computed once
+    and cached as read-only arrays, the cache is cleared whenever
+    data or units are set (eg by delete_frame or from_*)
     """ 
     def __init__(self):
         """
@@ -74,6 +284,7 @@ class FrameTime:
         col_num 
             number of columns
         """
+        self._views = {}
         self.col_num = 4
         self.units = None 
         self.data = None
@@ -81,13 +292,63 @@ class FrameTime:
         self.stop = 2
         self.duration = 3
 
+    def _get_data(self):
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._views = {}
+
+    data = property(_get_data, _set_data,
+                    doc='timing array, setting it clears cached views')
+
+    def _get_units_attr(self):
+        return self._units
+
+    def _set_units_attr(self, units):
+        self._units = units
+        self._views = {}
+
+    units = property(_get_units_attr, _set_units_attr,
+                     doc='units of data, setting it clears cached views')
+
+    def _cached_view(self, key, func):
+        """returns read-only array made by func, cached under key
+        until data or units change"""
+        if key not in self._views:
+            view = func()
+            if view is not None:
+                view = view.view()
+                view.flags.writeable = False
+            self._views[key] = view
+        return self._views[key]
+
+    def _scale(self, units):
+        """factor converting data to units"""
+        if self.units == 'min' and units == 'sec':
+            return 60.0
+        elif self.units == 'sec' and units == 'min':
+            return 1/60.0
+        return 1.0
+
+    def _frame_column(self, column, units):
+        """(n_rows, 2) array of frame numbers and column
+        times in units"""
+        if not units:
+            units = self.units
+        def frame_column():
+            times = np.column_stack([self.data[:, 0], self.data[:, column]])
+            times = times.astype(float)
+            times[:, 1] *= self._scale(units)
+            return times
+        return self._cached_view((column, units), frame_column)
+
     def correct_data_order(self, data):
         """
         If frame duration and frame stop time are switched, switch them back into the correct order.
         If there are any nan's, remove that frame.
         """
         n_rows, n_col = data.shape
-        print data
         if data[n_rows - 1, self.stop] < data[n_rows - 1, self.duration]:
             data[:, [self.stop, self.duration]] = data[:, [self.duration, self.stop]]
         data = data[~np.isnan(data).any(axis=1)]
@@ -124,53 +385,32 @@ class FrameTime:
     def _check_frame(self, frame, eps = 1e-4):
         """Checks a frame (1x4 array) for the proper shape,
         and if the duration is equal to stop_time - start_time."""
-        print frame
         if frame.shape[0] != self.col_num:
             logging.error('Bad number of columns')
             raise FrameError('Bad number of columns')
-            return False
         elif not (len(frame.shape) == 1 or frame.shape[1] == 1): 
             logging.error('Extra rows')
             raise FrameError('Extra rows')
-            return False
         elif abs(frame[self.duration] - (frame[self.stop] - frame[self.start])) > eps:
-            print frame[self.stop]
-            print frame[self.duration]
-            print frame[self.duration] - (frame[self.stop] - frame[self.start])
             logging.error('Frame entries unaligned')
             raise FrameError('Frame entries unaligned')
-            return False
         else:
             return True
 
     def _validate_frames(self, eps = 1e-4):
         """ 
-        Possible cases:
-            all frames in order 
-            frames in order- warning: missing frames
-            frames out of order - exception
-            negative frames - exception
-            0, 1 indexing (fix?)
-            overlapping timing, bad durations - exception
-            Does timing have to overlap exactly?
+        Checks all frames (see validate_frames), raises FrameError
+        describing every problem found:
+            missing or out of order frame numbers
+            negative frames
+            overlapping timing, bad durations, switched columns
         """
-        curr = 0 #can replace with fnum in loop
-        curr_start = 0
-        curr_stop = 0
-        for frame in self.data:
-            curr = curr + 1
-            if curr != frame[0]:
-                raise FrameError('Numbers not consecutive') #make Error classes
-                logging.error('Numbers not consecutive')
-            if frame[0] < 0:
-                logging.error('Negative frame number')
-                raise FrameError("Negative frame number") #make Error classes
-            if frame[self.start] < curr_stop:
-                logging.error('Frames overlapping')
-                raise FrameError("Overlapping frames") 
-            curr_start = frame[self.start]
-            curr_stop = frame[self.stop]
-            self._check_frame(frame)
+        problems = validate_frames(self.data, eps, self.start,
+                                   self.stop, self.duration)
+        if not problems['valid']:
+            msg = describe_problems(problems)
+            logging.error(msg)
+            raise FrameError(msg)
         return True
 
     def get_units(self):
@@ -181,13 +421,9 @@ class FrameTime:
     def generate_empty_protocol(self, frame_num):
         """Generates empty data array 
         """
-        outarray = np.array(np.zeros((frame_num, self.col_num)))
-        for i, f in enumerate(outarray):
-            f[0] = float(i) + 1
-            f[1] = np.nan
-            f[2] = np.nan
-            f[3] = np.nan
-        print outarray
+        outarray = np.empty((frame_num, self.col_num))
+        outarray[:] = np.nan
+        outarray[:, 0] = np.arange(1, frame_num + 1)
         return outarray
 
     def from_array(self, array, units):
@@ -198,35 +434,43 @@ class FrameTime:
         self.units = units
         return self 
 
-    def _time_from_ecat(self, ecat_file, ft_array):
-        """ fills in a fiels of empty ft_array using
-        data from the ecat mlist and subheaders"""
-        shdrs = ecat.load(ecat_file).get_subheaders()
-        mlist = ecat.load(ecat_file).get_mlist()
-        framelist = mlist.get_series_framenumbers().values()
-        for fn, shdr in zip(framelist, shdrs.subheaders):
-            start = shdr['frame_start_time'] / 1000
-            duration = shdr['frame_duration'] / 1000
-            idx = np.where(ft_array[:,0] == fn)
-            ft_array[idx, 1:] = [start, duration, start + duration]
-       
-    def from_ecats(self, ecat_files, units=None):
-        """Pulls timing info from ecat file(s) and stores in an array"""
+    @instrument.instrumented('FrameTime.from_ecats')
+    def from_ecats(self, ecat_files, units=None, nthreads=None):
+        """Pulls timing info from ecat file(s) and stores in an array.
+        Files are read concurrently (see read_ecat_timing), each frame
+        is placed by its frame number in the series.
+
+        Parameters
+        ----------
+            ecat_files:
+                ecat file or list of ecat files of one series
+            units:
+                the units of the data (default guessed)
+            nthreads:
+                number of threads reading files (default ECAT_THREADS)
+        """
         if not hasattr(ecat_files, '__iter__'):
             ecat_files = [ecat_files]
-        nframes = 0
-        for f in ecat_files:
-            hdr = ecat.load(f).get_header()
-            if hdr['num_frames'] > nframes:
-                nframes = hdr['num_frames']
-                print nframes
+        if nthreads is None:
+            nthreads = ECAT_THREADS
+        nthreads = max(1, min(nthreads, len(ecat_files)))
+        if nthreads == 1:
+            tables = map(read_ecat_timing, ecat_files)
+        else:
+            # reads are io bound, threads overlap the waits
+            pool = ThreadPool(nthreads)
+            try:
+                tables = pool.map(read_ecat_timing, ecat_files)
+            finally:
+                pool.close()
+                pool.join()
+        nframes = max(num_frames for num_frames, table in tables)
         empty_ft = self.generate_empty_protocol(nframes)
-
-        for ef in ecat_files:
-            self._time_from_ecat(ef, empty_ft)
-
-        self.data = np.array(empty_ft[0:,0:4]).astype(float)
-        # call to correct_data fails due to empty_ft dtype
+        for num_frames, table in tables:
+            rows = table[:, 0].astype(int) - 1
+            inseries = np.logical_and(rows >= 0, rows < nframes)
+            empty_ft[rows[inseries], 1:] = table[inseries, 1:]
+        self.data = empty_ft
         if not units:
             self.units = guess_units(self.data)
         else:
@@ -238,6 +482,7 @@ class FrameTime:
             raise DataError('Bad data', self.data, ecat_files)
         return self 
 
+    @instrument.instrumented('FrameTime.from_csv')
     def from_csv(self, csv_file, units=None): 
         """Pulls timing info from csv and stores in an array.
         Parameters
@@ -248,22 +493,7 @@ class FrameTime:
                 the units the imported data is in
         """
         try:
-            with open(csv_file) as infile:
-                header = infile.readline()
-                if header[0].isdigit():
-                    head = 0
-                else:
-                    head = 1
-            #workaround for weird delimiter issues
-            try:
-                data = np.genfromtxt(csv_file,
-                                     delimiter = ',',
-                                     skip_header = head)
-            except:
-                data = np.genfromtxt(csv_file, 
-                                     skip_header = head)
-            data = self.correct_data_order(data)
-            self.data = data[:, 0:4]
+            self.data = read_timing_table(csv_file)
 
             if not units:
                 self.units = guess_units(self.data)
@@ -278,6 +508,7 @@ class FrameTime:
             raise DataError('Bad data', self.data, csv_file)
         return self 
 
+    @instrument.instrumented('FrameTime.from_excel')
     def from_excel(self, excel_file, units=None):
         """Pulls timing info from excel file and stores in an array.
         Parameters
@@ -377,16 +608,16 @@ class FrameTime:
     def to_min(self):
         """Returns the frametime array in minutes."""
         if self.units == 'min':
-            return self.data
+            return self._cached_view('min', lambda: self.data)
         elif self.units == 'sec':
-            return self.data * 1/60.0
+            return self._cached_view('min', lambda: self.data * 1/60.0)
 
     def to_sec(self):
         """Returns the frametime array in seconds."""
         if self.units == 'sec':
-            return self.data
+            return self._cached_view('sec', lambda: self.data)
         elif self.units == 'min':
-            return 60.0 * self.data
+            return self._cached_view('sec', lambda: 60.0 * self.data)
 
     def get_data(self, units):
         """Return timing info as numpy array"""
@@ -396,44 +627,91 @@ class FrameTime:
             return self.to_sec()
 
     def get_start_times(self, units = None):
-        if not units:
-            units = self.units
-        n_rows, n_col = self.data.shape
-        start_times = np.zeros((n_rows, 2))
-        for k, row in enumerate(self.data):
-            start_times[k, 0] = row[0]
-            start_times[k, 1] = row[self.start] 
-        if self.units == 'min' and units == 'sec':
-            return start_times*60.0
-        elif self.units == 'sec' and units == 'min':
-            return start_times/60.0
-        return start_times
+        """(n_rows, 2) array of frame number and start time in units
+        (default self.units)"""
+        return self._frame_column(self.start, units)
 
     def get_stop_times(self, units = None):
-        if not units:
-            units = self.units
-        n_rows, n_col = self.data.shape
-        stop_times = np.zeros((n_rows, 2))
-        for k, row in enumerate(self.data):
-            stop_times[k, 0] = row[0]
-            stop_times[k, 1] = row[self.stop] 
-        if self.units == 'min' and units == 'sec':
-            return stop_times*60.0
-        elif self.units == 'sec' and units == 'min':
-            return stop_times/60.0
-        return stop_times
-
+        """(n_rows, 2) array of frame number and stop time in units
+        (default self.units)"""
+        return self._frame_column(self.stop, units)
 
     def get_midtimes(self, units=None):
+        """(n_rows, 2) array of frame number and frame midtime
+        (start + duration / 2) in units (default self.units)"""
         if not units:
             units = self.units
-        n_rows, n_col = self.data.shape
-        midtimes = np.zeros((n_rows, 2))
-        for k, row in enumerate(self.data):
-            midtimes[k, 0] = row[0]
-            midtimes[k, 1] = row[self.start] + row[self.duration]/2.0 
-        if self.units == 'min' and units == 'sec':
-            return midtimes*60.0
-        elif self.units == 'sec' and units == 'min':
-            return midtimes/60.0
-        return midtimes
+        def midtimes():
+            times = np.column_stack([self.data[:, 0],
+                                     self.data[:, self.start] +
+                                     self.data[:, self.duration] / 2.0])
+            times = times.astype(float)
+            times[:, 1] *= self._scale(units)
+            return times
+        return self._cached_view(('mid', units), midtimes)
+
+
+VALIDATION_FIELDS = ['file', 'nframes', 'valid'] + FRAME_PROBLEMS + ['error']
+
+def _validate_timing_file(args):
+    """validates one timing file, never raises,
+    returns summary row (dict) for it"""
+    filename, eps = args
+    row = dict(file=filename, valid=False, error='')
+    try:
+        row.update(validate_frames(read_timing_table(filename, False),
+                                   eps))
+    except Exception as err:
+        row['error'] = '%s: %s'%(type(err).__name__, err)
+    return row
+
+@instrument.instrumented()
+def validate_timing_files(timing_files, eps=1e-4, nprocs=None,
+                          pattern='*.csv'):
+    """
+    Validates many timing files in a pool of worker processes
+    (see validate_frames), files are checked as read, before any
+    correction of column order or removal of incomplete frames.
+
+    Parameters
+    ----------
+        timing_files:
+            directory (files matching pattern are used),
+            or list of csv timing files
+        eps:
+            tolerance for duration == stop_time - start_time
+        nprocs:
+            number of worker processes (default: number of cpus)
+        pattern:
+            glob pattern of timing files in a directory
+
+    Returns
+    -------
+        summary: pandas DataFrame
+            one row per file (in sorted or given order), columns
+            VALIDATION_FIELDS, error is set if the file could not be read
+    """
+    if isinstance(timing_files, basestring):
+        if isdir(timing_files):
+            timing_files = sorted(glob(join(timing_files, pattern)))
+        else:
+            timing_files = [timing_files]
+    jobs = [(filename, eps) for filename in timing_files]
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, len(jobs)))
+    if nprocs == 1:
+        rows = map(_validate_timing_file, jobs)
+    else:
+        # files are small, hand each worker a few large chunks
+        chunksize = max(1, len(jobs) // (4 * nprocs))
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            rows = pool.map(_validate_timing_file, jobs, chunksize)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return DataFrame(rows, columns=VALIDATION_FIELDS)
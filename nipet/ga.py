@@ -4,12 +4,38 @@ import os
 from glob import glob
 import time
 import tempfile
+from collections import OrderedDict
+import multiprocessing
+import multiprocessing.sharedctypes
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import nibabel as ni
-import scipy.integrate
-import matplotlib.pyplot as plt
 import frametime
+import instrument
+import viewer
 
+# default memory (bytes) for voxel-by-frame working arrays in calc_ki_blocks
+DEFAULT_MEMORY_BUDGET = 512 * 1024 ** 2
+# voxel-by-frame sized arrays alive at once per block (data, x, y
+# and the steady state copies / deviations used by get_lstsq_batch)
+BLOCK_ARRAYS = 8
+# aparc labels of the cortical regions making up the PIB index
+PIB_INDEX_LABELS = [1003,
+                    1012,1014,1018,1019,1020,1027,1028,1032,1008,
+                    1025,1029,1031,1002,1023,1010,1026,2003,
+                    2012,2014,2018,2019,2020,2027,2028,2032,2008,
+                    2025,2029,2031,2002,2023,2010,2026,1015,1030,
+                    2015,2030,2009,1009]
+# float32 mode (dtype=np.float32) keeps voxel data, integrals and fits
+# in float32, sums in the fits are accumulated in float64, DVR agrees
+# with the float64 path to within FLOAT32_RTOL (relative) for data
+# whose steady state Logan plot is well fit by a line
+FLOAT32_RTOL = 1e-4
+# threads writing maps in a NiftiWriter
+NIFTI_WRITER_THREADS = 4
+# number of frame protocols whose integration operator is kept
+INTEGRATION_CACHE_SIZE = 8
+_integration_cache = OrderedDict()
 
 class Logan(object):
     """Calculates simplified Logan Graphical Analysis on 
@@ -21,9 +47,46 @@ class Logan(object):
         were calculated
     ref_counts : numpy array or list
         tracer counts in reference region at each timestep
+    k2ref : float
+        k2 of reference region
+    range : tuple
+        range of steady state data (in minutes)
+    mask : str or numpy array
+        mask of voxels to fit in frames added with add_frame,
+        default is all voxels
+    refroi : str or numpy array
+        reference region, used to get the reference counts of frames
+        added with add_frame (see get_ref)
+    timing : frametime.FrameTime or numpy array
+        timing of the frames (see calc_ki), needed to select the
+        steady state frames (see from_frametime)
 
+    The integrated reference, the reference part of the Logan x term
+    and the steady state frame selection are computed once when first
+    used and cached, so fitting many regions or voxels of a scan does
+    not repeat them. Setting timesteps, ref_counts, timing, k2ref or
+    range, or adding a frame, clears the cache, clear_cache() can also
+    be called directly.
+
+    >>> logan = Logan.from_frametime(timing, ref)
+    >>> dvr, intercept, resid = logan.fit_region(tac)
+    >>> allki, allvd, resids = logan.fit_voxels(masked_data)
+
+    Frames can be analysed as they arrive, starting from empty
+    timesteps and ref_counts:
+
+    >>> logan = Logan(np.array([]), np.array([]), mask=mask, refroi=ref)
+    >>> for frame, row in zip(frames, timing.get_data('sec')):
+    ...     logan.add_frame(frame, row)
+    ...     dvr = logan.slope_map()
+
+    each frame updates the running integrals and regression sums of
+    every voxel, so earlier frames are never reprocessed
     """
-    def __init__(self, timesteps, ref_counts):
+    def __init__(self, timesteps, ref_counts, k2ref=.15, range=(35,90),
+                 mask=None, refroi=None, timing=None):
+        timesteps = np.asarray(timesteps, dtype=float)
+        ref_counts = np.asarray(ref_counts, dtype=float)
         if not timesteps.shape == ref_counts.shape:
             msg = """Number of timesteps and reference region
             samples must be the same
@@ -31,25 +94,314 @@ class Logan(object):
             reference samples = %s"""%(timesteps.shape, ref_counts.shape)
             raise IOError(msg)
 
+        self._cache = {}
         self.timesteps = timesteps
         self.ref_counts = ref_counts
+        self.k2ref = k2ref
+        self.range = range
+        self.mask = mask
+        self.refroi = refroi
+        self.timing = timing
+        self._stream = None
+
+    @classmethod
+    def from_frametime(cls, timing, ref_counts, **kwargs):
+        """ Logan with timesteps from the midtimes (sec)
+        of frametime.FrameTime timing"""
+        timesteps = timing.get_midtimes('sec')[:, 1]
+        return cls(timesteps, ref_counts, timing=timing, **kwargs)
+
+    def _get_timesteps(self):
+        return self._timesteps
+
+    def _set_timesteps(self, timesteps):
+        self._timesteps = timesteps
+        self.clear_cache()
+
+    timesteps = property(_get_timesteps, _set_timesteps)
+
+    def _get_ref_counts(self):
+        return self._ref_counts
+
+    def _set_ref_counts(self, ref_counts):
+        self._ref_counts = ref_counts
+        self.clear_cache()
+
+    ref_counts = property(_get_ref_counts, _set_ref_counts)
+
+    def _get_timing(self):
+        return self._timing
+
+    def _set_timing(self, timing):
+        if timing is not None:
+            timing = timing_array(timing)
+        self._timing = timing
+        self.clear_cache()
+
+    timing = property(_get_timing, _set_timing)
+
+    def _get_k2ref(self):
+        return self._k2ref
+
+    def _set_k2ref(self, k2ref):
+        self._k2ref = k2ref
+        self.clear_cache()
+
+    k2ref = property(_get_k2ref, _set_k2ref)
+
+    def _get_range(self):
+        return self._range
+
+    def _set_range(self, range):
+        self._range = range
+        self.clear_cache()
+
+    range = property(_get_range, _set_range)
 
+    def clear_cache(self):
+        """drops cached intermediates (eg in long lived workers)"""
+        self._cache.clear()
 
+    def _cached(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = func()
+        return self._cache[name]
+
+    @property
+    def int_ref(self):
+        """integrated reference at each timestep (0 at the first)"""
+        return self._cached('int_ref', lambda: integrate_reference(
+            self.ref_counts, self.timesteps))
+
+    @property
+    def ref_term(self):
+        """ numerator of the Logan x term, for frames 1 on
+        integrated_reference + (1 / k2ref) * reference"""
+        return self._cached('ref_term', lambda: self.int_ref[1:] +
+                            (1 / self.k2ref) * self.ref_counts[1:])
+
+    @property
+    def window(self):
+        """boolean selection of steady state frames (frames 1 on)"""
+        def window():
+            if self.timing is None:
+                raise IOError('timing is needed to select frames')
+            return np.logical_and(self.timing[1:,0] / 60. >= self.range[0],
+                                  self.timing[1:,2] / 60. <= self.range[1])
+        return self._cached('window', window)
+
+    def region_xy(self, tac):
+        """ Logan x and y terms of a regional TAC (frames 1 on)"""
+        tac = np.asarray(tac, dtype=float)
+        y = integrate_reference(tac, self.timesteps)[1:] / tac[1:]
+        x = self.ref_term / tac[1:]
+        return x, y
+
+    def fit_region(self, tac):
+        """ Logan slope (DVR), intercept and residuals of a regional
+        TAC, fit on the steady state frames"""
+        x, y = self.region_xy(tac)
+        return get_lstsq(x[self.window], y[self.window])
+
+    def voxel_xy(self, masked_dat):
+        """ Logan x and y terms of masked data, see calc_xy"""
+        return calc_xy(self.ref_counts, masked_dat, self.timesteps,
+                       k2ref=self.k2ref, int_ref=self.int_ref)
+
+    def fit_voxels(self, masked_dat):
+        """ Logan slope (DVR), intercept and residuals of each voxel
+        in masked data (nvoxels, nframes), see calc_ki"""
+        x, y = self.voxel_xy(masked_dat)
+        return get_lstsq_batch(x[:, self.window], y[:, self.window])
+
+    def plot_values(self, tac):
+        """ x, y and fitted y of a regional TAC, for Logan plots"""
+        x, y = self.region_xy(tac)
+        slope, intercept, residues = self.fit_region(tac)
+        return x, y, x * slope + intercept
+
+    def _start_stream(self, frame):
+        """sets up running state for frames of shape frame.shape"""
+        shape = frame.shape
+        if self.mask is None:
+            index = np.arange(frame.size, dtype=np.int32)
+        else:
+            index = roi_index(self.mask, shape)
+        coords = np.unravel_index(index, shape)
+        refcoords = None
+        if self.refroi is not None:
+            refcoords = np.unravel_index(roi_index(self.refroi, shape),
+                                         shape)
+        nvox = index.shape[0]
+        self._stream = dict(shape=shape, index=index, coords=coords,
+                            refcoords=refcoords,
+                            previous=None, int_dat=np.zeros(nvox),
+                            int_ref=0., valid=np.ones(nvox, dtype=bool),
+                            logan=RunningFit(nvox), patlak=RunningFit(nvox))
+
+    def add_frame(self, frame, frame_row, ref_count=None, units='sec'):
+        """ adds the next frame, updating running integrals and the
+        running Logan and Patlak regression sums in O(voxels)
+
+        Parameters
+        ----------
+        frame : numpy array
+            3D frame data
+        frame_row : numpy array
+            row of frametime.FrameTime data for the frame
+            (frame number, start, stop, duration)
+        ref_count : float
+            reference counts of the frame, default is the
+            mean of refroi voxels > 0 in frame (see get_ref)
+        units : str
+            units of frame_row, one of ['sec', 'min']
+        """
+        if self._stream is None:
+            if self.timesteps.shape[0] > 0:
+                raise IOError('frames can only be added to a Logan '
+                              'started without timesteps')
+            self._start_stream(frame)
+        stream = self._stream
+        if not frame.shape == stream['shape']:
+            raise IOError('frame has shape %s, not %s'%(frame.shape,
+                                                       stream['shape']))
+        ft = frametime.FrameTime()
+        scale = 60. if units == 'min' else 1.
+        start = frame_row[ft.start] * scale
+        stop = frame_row[ft.stop] * scale
+        midtime = start + frame_row[ft.duration] * scale / 2.
+        if ref_count is None:
+            if stream['refcoords'] is None:
+                raise IOError('ref_count or refroi is needed')
+            refvals = np.nan_to_num(frame[stream['refcoords']])
+            ref_count = refvals[refvals > 0].mean()
+        dat = np.nan_to_num(np.array(frame[stream['coords']], dtype=float))
+        stream['valid'] &= dat != 0
+        if stream['previous'] is not None:
+            half_dt = (midtime - self.timesteps[-1]) / 2.
+            stream['int_dat'] += half_dt * (stream['previous'] + dat)
+            stream['int_ref'] += half_dt * (self.ref_counts[-1] + ref_count)
+            if start / 60. >= self.range[0] and stop / 60. <= self.range[1]:
+                # voxels with a zero frame are not valid, and set to 0
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    y = stream['int_dat'] / dat
+                    x = (stream['int_ref'] + ref_count / self.k2ref) / dat
+                    stream['logan'].add(x, y)
+                stream['patlak'].add(stream['int_ref'] / ref_count,
+                                     dat / ref_count)
+        stream['previous'] = dat
+        self.timesteps = np.append(self.timesteps, midtime)
+        self.ref_counts = np.append(self.ref_counts, ref_count)
+        row = np.array([[start, stop - start, stop]])
+        if self.timing is None:
+            self.timing = row
+        else:
+            self.timing = np.vstack([self.timing, row])
+
+    def _stream_fit(self, name):
+        if self._stream is None:
+            raise IOError('no frames have been added')
+        valid = self._stream['valid']
+        return [np.where(valid, result, 0.)
+                for result in self._stream[name].fit()]
+
+    def slope(self):
+        """ current Logan slope (DVR), intercept and residuals of
+        the voxels in mask, from frames added so far"""
+        return self._stream_fit('logan')
+
+    def patlak_slope(self):
+        """ current Patlak slope (Ki), intercept and residuals of
+        the voxels in mask, from frames added so far"""
+        return self._stream_fit('patlak')
+
+    def slope_map(self, patlak=False):
+        """ current Logan (or Patlak) slope as a 3D map"""
+        if patlak:
+            slope = self.patlak_slope()[0]
+        else:
+            slope = self.slope()[0]
+        return results_to_array(slope, self._stream['index'],
+                                shape=self._stream['shape'])
+
+
+class RunningFit(object):
+    """running least squares line fits, for arrays of points
+    added one at a time (Welford updates of the means and
+    co-moments, numerically stable)
+
+    Parameters
+    ----------
+    shape : int or tuple
+        shape of the x and y arrays that will be added
+    """
+    def __init__(self, shape):
+        self.n = 0
+        self.xmean = np.zeros(shape)
+        self.ymean = np.zeros(shape)
+        self.cxx = np.zeros(shape)
+        self.cxy = np.zeros(shape)
+        self.cyy = np.zeros(shape)
+
+    def add(self, x, y):
+        """adds one point (x, y) to every fit"""
+        self.n += 1
+        dx = x - self.xmean
+        dy = y - self.ymean
+        self.xmean += dx / self.n
+        self.ymean += dy / self.n
+        self.cxx += dx * (x - self.xmean)
+        self.cxy += dx * (y - self.ymean)
+        self.cyy += dy * (y - self.ymean)
+
+    def fit(self):
+        """returns slope, intercept and residues of the fits so far"""
+        if self.n < 2:
+            zeros = np.zeros(self.xmean.shape)
+            return zeros, zeros.copy(), zeros.copy()
+        slope, intercept, residues, r2 = fit_from_sums(
+            self.n, 0., 0., self.cxx, self.cxy, self.cyy)
+        intercept = np.where(self.cxx > 0,
+                             self.ymean - slope * self.xmean, 0.)
+        return slope, intercept, residues
+
+
+@instrument.instrumented()
 def get_ref(refroi, dat):
     """given region of interest, extracts mean for each frame
     in dat, returns vector of means across time
+    voxels <= 0 (or nan) in a frame are excluded from that frame's mean
+
+    refroi can be a file, a 3D array, or a flat voxel index of the
+    region (see roi_index), the index skips loading and masking the
+    region on repeated calls
     """
-    refdat = ni.load(refroi).get_data().squeeze()
-    if not refdat.shape == dat.shape[:-1]:
-        raise IOError('%s has shape %s, not %s'%(refroi, refdat.shape, 
-                                                 dat.shape[1:]))
-    means = np.zeros(dat.shape[-1])
-    refdat = np.nan_to_num(refdat)
-    for val,slice in enumerate(dat.T):
-        ind = np.logical_and(slice > 0,
-                             refdat.T > 0)
-        means[val] = slice[ind].mean()
-    return means
+    index = roi_index(refroi, dat.shape[:-1])
+    vals = dat[np.unravel_index(index, dat.shape[:-1])]
+    with np.errstate(invalid='ignore'):
+        positive = vals > 0
+    vals = np.where(positive, vals, 0)
+    return np.true_divide(vals.sum(axis=0, dtype=np.float64),
+                          positive.sum(axis=0))
+
+def roi_index(refroi, shape=None):
+    """given region of interest (or mask) file or 3D array, return
+    flat (C order) int32 index of its voxels > 0 (nan is ignored)
+    flat integer indices are returned unchanged
+    if shape is given, raise IOError if region does not match"""
+    if isinstance(refroi, basestring):
+        name = refroi
+        refdat = ni.load(refroi).get_data().squeeze()
+    else:
+        name = 'reference region'
+        refdat = np.asarray(refroi)
+        if refdat.ndim == 1 and refdat.dtype.kind in 'iu':
+            return refdat
+    if shape is not None and not refdat.shape == shape:
+        raise IOError('%s has shape %s, not %s'%(name, refdat.shape,
+                                                 shape))
+    with np.errstate(invalid='ignore'):
+        return mask_index(refdat > 0)
 
 def is_iterable(input):
     """checks if object can be iterated"""
@@ -58,42 +410,139 @@ def is_iterable(input):
     else:
         return False
 
-def load_3d(infiles):
+@instrument.instrumented()
+def load_3d(infiles, dtype=np.float64):
     """given a list of 3d frames, load into 4D array
-    retun array of shape (frame, x, y, z) with nan removed"""
-    tmp = ni.concat_images(infiles)
-    return np.nan_to_num(tmp.get_data())
+    retun array of shape (x, y, z, frame) with nan removed
+    frames are copied one at a time into a preallocated array
+    of dtype (default float64, whatever the file dtype)"""
+    first = ni.load(infiles[0]).get_data().squeeze()
+    dat4d = np.empty(first.shape + (len(infiles),), dtype=dtype)
+    for val, infile in enumerate(infiles):
+        if val == 0:
+            frame = first
+        else:
+            frame = ni.load(infile).get_data().squeeze()
+        if not frame.shape == first.shape:
+            raise IOError('%s has shape %s, not %s'%(infile, frame.shape,
+                                                     first.shape))
+        dat4d[..., val] = frame
+        np.nan_to_num(dat4d[..., val], copy=False)
+    return dat4d
 
-def get_data_nibabel(infiles):
+@instrument.instrumented()
+def get_data_nibabel(infiles, dtype=None):
     """ uses nibabel to open nifti file
-    and return a 4d array of data"""
+    and return a 4d array of data
+    a set of 3D frames is loaded into memory (see load_3d), a single
+    4D file is returned as a Frames4D, which reads frames or voxel
+    blocks on demand
+    dtype np.float32 loads the data in float32 (see FLOAT32_RTOL),
+    default is float64 whatever the file dtype"""
+    if dtype is None:
+        dtype = np.float64
     if is_iterable(infiles):
         # set of 3D frames
-        dat4d = load_3d(infiles)
+        dat4d = load_3d(infiles, dtype=dtype)
         return dat4d
     else:
-        print '4d files not supported yet'
-        return None
+        return Frames4D(infiles, dtype=dtype)
+
+
+class Frames4D(object):
+    """Lazy, array-like access to the data in a 4D image file
+
+    Uncompressed files are memory-mapped, compressed files are held
+    in memory unscaled (in their on-disk dtype).
+    Indexing (eg frames4d[..., 3] or frames4d[i, j, k] with index
+    arrays) returns a float64 (or dtype) copy of only the requested
+    data, with scaling applied and nan set to 0
+
+    Parameters
+    ----------
+    infile : str
+        4D image file (x, y, z, frames)
+    dtype : numpy dtype
+        float dtype of the data returned, np.float32 halves the
+        memory of data read from float32 or scaled int16 files
+    """
+    ndim = 4
+
+    def __init__(self, infile, dtype=np.float64):
+        img = ni.load(infile)
+        if not len(img.shape) == 4:
+            raise IOError('%s has shape %s, not 4D'%(infile, img.shape))
+        self.filename = infile
+        self.shape = img.shape
+        self.affine = img.get_affine()
+        self._slope = img.dataobj.slope
+        self._inter = img.dataobj.inter
+        self._raw = img.dataobj.get_unscaled()
+        self.is_mmap = isinstance(self._raw, np.memmap)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        block = np.asarray(self._raw[key])
+        if (not block.dtype == self.dtype or
+                np.may_share_memory(block, self._raw)):
+            block = block.astype(self.dtype)
+        if self._slope != 1:
+            block *= self._slope
+        if self._inter != 0:
+            block += self._inter
+        return np.nan_to_num(block, copy=False)
 
-def mask_data(mask, dat4d):
+    def __array__(self, dtype=None):
+        dat = self[...]
+        if dtype is not None:
+            dat = dat.astype(dtype)
+        return dat
+
+    @property
+    def nframes(self):
+        return self.shape[-1]
+
+    def frame(self, frame):
+        """returns 3D array of one frame"""
+        return self[..., frame]
+
+    def iter_frames(self):
+        """yields 3D arrays one frame at a time"""
+        for frame in xrange(self.nframes):
+            yield self.frame(frame)
+
+
+@instrument.instrumented()
+def mask_data(mask, dat4d, dtype=None):
     """given a mask file and a 4d array
     mask data with data in maskfile
-    return maksed_data and mask_bool"""
-    nframes = dat4d.shape[-1]
-    maskdat = ni.load(mask).get_data().squeeze()
-    if not maskdat.shape == dat4d.shape[:-1]:
-        raise IOError('shape mismatch, %s: %s and dat4d: %s'%(mask,
-                                                              maskdat.shape,
-                                                              dat4d.shape[:-1]))
-    # mask for both anatomical and PET data (logical_and mask
-    data_mask = dat4d.all(axis=-1) > 0
-    fullmask = np.logical_and(maskdat>0, data_mask)
-                             
-    new = np.empty((fullmask[fullmask].size,nframes))
-    for i in np.arange(nframes):
-        new[:,i] = dat4d[:,:,:,i][fullmask].flatten()
-    new.shape = (fullmask[fullmask].size, nframes)
-    return new, fullmask
+    return masked_data, shape (nvoxels, nframes), and the flat (C order)
+    int32 index of the masked voxels (see mask_index), used by
+    results_to_array and save_data2nii to put results back in place
+
+    only voxels in mask with no zero frames are kept, the data are
+    gathered once, dat4d can also be a Frames4D
+    masked data are converted to dtype if given (eg np.float32)"""
+    index = roi_index(mask, dat4d.shape[:-1])
+    masked, index = masked_voxels(dat4d, index)
+    if dtype is not None:
+        masked = masked.astype(dtype, copy=False)
+    return masked, index
+
+def masked_voxels(dat4d, index):
+    """gathers the voxels in flat index from dat4d into an
+    (nvoxels, nframes) array, dropping voxels with a zero frame
+    returns the data and the index of the voxels kept"""
+    new = dat4d[np.unravel_index(index, dat4d.shape[:-1])]
+    # mask for both anatomical and PET data
+    keep = new.all(axis=-1)
+    if not keep.all():
+        new = new[keep]
+        index = index[keep]
+    return new, index
 
 def get_ki_vd_lstsq(x,y):
     """solves best fitting line using np.linalg.lstsq
@@ -117,43 +566,148 @@ def get_ki_vd_polyfit(x,y):
 def integrate_reference(reference_data, delta_time):
     """
     returns a cumulative integration of reference_data with delta_time
-    uses np.cumtrapz"""
-    int_ref = np.zeros(reference_data.shape)
-    int_ref[1:] = scipy.integrate.cumtrapz(reference_data, delta_time)
-    return int_ref
+    (the frame midtimes), the first frame is 0
+    uses the cached integration_operator"""
+    return integration_operator(delta_time).dot(reference_data)
 
     
 def save_inputplot(ref, midframes, outdir):
-    """saves input TAC to png figure
+    """saves input TAC to png figure (see viewer.input_plot)
+    returns the figure name, None if figures are off
     """
-    fig = plt.figure()
-    fig.set_label('Reference TAC')
-    ax1 = fig.add_subplot(111)
-    ax1.plot(midframes,ref, 'ko-')
-    ax2 = ax1.twiny()
-    ax1.set_xlabel('midframe times (sec)')
-    ax1.set_ylabel('counts bq/ml')
-    ax2.set_xlabel('midframe times (min)')
-    xticks_minutes = (ax1.get_xticks() / 60.).round()
-    ax2.set_xticks(xticks_minutes)
-    ax1.grid()
     basename = 'REF_TAC_%s'%(time.strftime('%Y-%m-%d-%H-%M'))
     figname = os.path.join(outdir, '%s.png'%(basename))
-    plt.savefig(figname, format='png') 
-    fig.clf()
-    return figname
+    if viewer.render(viewer.input_plot, ref, midframes, figname):
+        return figname
   
-def save_data2nii(data, reference_img, filename='generic_file',outdir='.'):
+@instrument.instrumented()
+def save_data2nii(data, reference_img, filename='generic_file',outdir='.',
+                  index=None):
     """saves data to nifti file given affine info in reference_img
-    and data array"""
-    img = ni.load(reference_img)
-    data = np.reshape(data, img.get_shape())
-    out_img = ni.Nifti1Image(data, img.get_affine())
-    outfile = os.path.join(outdir, 
-                           '%s_%s.nii.gz'%(filename,
-                                           time.strftime('%Y-%m-%d-%H-%M')))
-    out_img.to_filename(outfile)
-    return outfile
+    and data array
+    if index (flat voxel index, see mask_data) is given, data holds
+    one value per voxel in index, and is scattered into the image
+    to write several maps of one image use a NiftiWriter"""
+    writer = NiftiWriter(reference_img, outdir=outdir, nthreads=0)
+    return writer.write(data, filename=filename, index=index)
+
+
+def geometry_header(header):
+    """ new Nifti1Header with only the geometry of header (pixdim,
+    qform and sform with their codes, xyzt_units), fields describing
+    the reference data (cal_min/cal_max, intent, descrip, aux_file)
+    are left at their defaults"""
+    new = ni.Nifti1Header()
+    new['pixdim'] = header['pixdim']
+    new.set_qform(*header.get_qform(coded=True))
+    new.set_sform(*header.get_sform(coded=True))
+    new.set_xyzt_units(*header.get_xyzt_units())
+    return new
+
+
+class NiftiWriter(object):
+    """Writes maps (eg DVR, intercept, residuals) in the space of one
+    reference image, whose affine and header are loaded once
+
+    Maps are scattered from the voxel index (see mask_data) on the
+    calling thread, then compressed and written in a pool of
+    background threads (zlib releases the GIL, so maps are written
+    concurrently). Call join (or flush, or close, or use as a context
+    manager) before the process exits, it waits for all writes and
+    raises the first error
+
+    Parameters
+    ----------
+    reference_img : str
+        image file (eg the mask) giving affine, geometry and shape
+    outdir : str
+        directory of output files
+    index : numpy array
+        flat voxel index of the values of maps written (see image),
+        without it maps are whole images
+    nthreads : int
+        number of writing threads, 0 writes on the calling thread
+        (default NIFTI_WRITER_THREADS)
+    """
+    def __init__(self, reference_img, outdir='.', index=None,
+                 nthreads=None):
+        img = ni.load(reference_img)
+        self.shape = img.shape
+        self.affine = img.get_affine()
+        self.header = geometry_header(img.header)
+        self.outdir = outdir
+        self.index = index
+        if nthreads is None:
+            nthreads = NIFTI_WRITER_THREADS
+        self.nthreads = nthreads
+        self._pool = None
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def filename(self, filename='generic_file'):
+        """ output file for filename (timestamped as save_data2nii)"""
+        return os.path.join(self.outdir, 
+                            '%s_%s.nii.gz'%(filename,
+                                            time.strftime('%Y-%m-%d-%H-%M')))
+
+    def image(self, data, index=None):
+        """ Nifti1Image of data, scattered from index (default
+        self.index) if given, with the reference affine and geometry
+        (see geometry_header)"""
+        if index is None:
+            index = self.index
+        if index is not None:
+            data = results_to_array(data, index, shape=self.shape)
+        else:
+            data = np.reshape(data, self.shape)
+        header = self.header.copy()
+        header.set_data_dtype(data.dtype)
+        header.set_slope_inter(1, 0)
+        return ni.Nifti1Image(data, self.affine, header)
+
+    def write(self, data, filename='generic_file', index=None):
+        """ writes data (see image) to filename (see filename) in the
+        background, returns the output file name
+        data given without an index is written as is, and must not
+        be changed until join"""
+        outfile = self.filename(filename)
+        img = self.image(data, index=index)
+        if self.nthreads == 0:
+            img.to_filename(outfile)
+            return outfile
+        if self._pool is None:
+            self._pool = ThreadPool(self.nthreads)
+        self._pending.append(self._pool.apply_async(img.to_filename,
+                                                    (outfile,)))
+        return outfile
+
+    @instrument.instrumented('NiftiWriter.join')
+    def join(self):
+        """ waits for all maps written so far, raises the first
+        error of any write"""
+        pending, self._pending = self._pending, []
+        for result in pending:
+            result.wait()
+        for result in pending:
+            result.get()
+
+    flush = join
+
+    def close(self):
+        """ joins and stops the writing threads"""
+        try:
+            self.join()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
     
 
 def repmat_1d(x, n):
@@ -163,17 +717,90 @@ def repmat_1d(x, n):
     newx.shape = tuple([n] + [i for i in x.shape])
     return newx
 
-def calc_xy(ref, masked_dat,midtimes, k2ref=.15):
+def float_dtype(*arrays):
+    """ float dtype of results computed from arrays, float32 if all
+    arrays are float32 (see FLOAT32_RTOL), otherwise float64"""
+    if all(np.asarray(array).dtype == np.float32 for array in arrays):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def integration_operator(midtimes):
+    """ returns the (nframes, nframes) lower triangular matrix W that
+    integrates frame data sampled at midtimes, so W.dot(tac) is the
+    cumulative trapezoidal integral of tac (with 0 for the first frame,
+    as integrate_reference)
+
+    operators are cached by midtimes (one per frame protocol), the
+    INTEGRATION_CACHE_SIZE most recently used are kept
+    see clear_integration_cache"""
+    midtimes = np.asarray(midtimes, dtype=np.float64)
+    key = (midtimes.shape, midtimes.tostring())
+    if key in _integration_cache:
+        operator = _integration_cache.pop(key)
+    else:
+        nframes = midtimes.shape[0]
+        half_dt = np.diff(midtimes) / 2.
+        operator = np.zeros((nframes, nframes))
+        # integral to frame k adds half of frame k-1 and k
+        operator[np.arange(1, nframes), np.arange(nframes - 1)] = half_dt
+        operator[np.arange(1, nframes), np.arange(1, nframes)] = half_dt
+        operator = np.cumsum(operator, axis=0)
+        operator.flags.writeable = False
+        while len(_integration_cache) >= INTEGRATION_CACHE_SIZE:
+            _integration_cache.popitem(last=False)
+    _integration_cache[key] = operator
+    return operator
+
+def clear_integration_cache():
+    """removes all cached integration operators"""
+    _integration_cache.clear()
+
+@instrument.instrumented()
+def integrate_frames(data, midtimes, out=None):
+    """cumulative trapezoidal integration of data, shape (nvoxels, nframes),
+    along the frame axis against the 1D vector midtimes
+    returns array of shape (nvoxels, nframes - 1), same as
+    scipy.integrate.cumtrapz(data, midtimes, axis=1) or
+    data.dot(integration_operator(midtimes)[1:].T)
+
+    the cached operator is applied through its banded form (it is the
+    cumulative sum of a bidiagonal matrix of half frame intervals),
+    in place and without building any intermediate (nvoxels, nframes)
+    arrays, each voxel gets the same result however many voxels are
+    integrated together (a BLAS matrix product does not guarantee this)
+    results are written into out if given, float32 data are
+    integrated in float32"""
+    half_dt = integration_operator(midtimes).diagonal()[1:]
+    if out is None:
+        out = np.empty((data.shape[0], data.shape[1] - 1),
+                       dtype=float_dtype(data))
+    np.add(data[:, :-1], data[:, 1:], out=out)
+    out *= half_dt
+    np.cumsum(out, axis=1, out=out)
+    return out
+
+@instrument.instrumented()
+def calc_xy(ref, masked_dat,midtimes, k2ref=.15, int_ref=None):
     """calculates the x and y terms used in Logan Graphical Analysis
     y = integrated_data / data
     x = integrated_reference / data + (1 / k2ref) * reference / data
+
+    the reference is integrated once as a 1D vector, and the data
+    are integrated along the frame axis against the 1D midtimes, so
+    only the x and y arrays are allocated at (nvoxels, nframes - 1)
+    int_ref, the integrated reference (see integrate_reference)
+    can be passed in when it has already been computed
+    x and y are float32 for float32 masked_dat (see FLOAT32_RTOL)
     """
-    big_durs = repmat_1d(midtimes,masked_dat.shape[0])
-    int_dat = scipy.integrate.cumtrapz(masked_dat.T,big_durs.T,axis=0)
-    big_ref = repmat_1d(ref,masked_dat.shape[0])
-    int_ref = scipy.integrate.cumtrapz(big_ref.T,big_durs.T, axis=0)
-    y = (int_dat.T)  / masked_dat[:,1:]# 33, nvox in mask
-    x = (int_ref.T / masked_dat[:,1:]) + ( 1 / k2ref) *(big_ref[:,1:] / masked_dat[:,1:]) 
+    dat = masked_dat[:, 1:]
+    y = integrate_frames(masked_dat, midtimes)
+    y /= dat # 33, nvox in mask
+    if int_ref is None:
+        int_ref = integrate_reference(ref, midtimes)
+    int_ref = int_ref[1:]
+    # reference terms are 1D, computed in float64
+    refterm = (int_ref + (1 / k2ref) * ref[1:]).astype(y.dtype)
+    x = np.divide(refterm, dat, dtype=y.dtype)
     return x,y    
 
 def get_lstsq(x,y):
@@ -188,9 +815,85 @@ def get_lstsq(x,y):
     residues = results[1]
     return ki,vd,residues
 
+def sum_frames(data):
+    """sums data of shape (nvoxels, nframes) over frames, adding one
+    frame at a time so the result for each voxel does not depend on
+    how many voxels are summed together (see calc_ki_blocks)
+    the sum is accumulated in float64"""
+    total = data[:, 0].astype(np.float64)
+    for frame in xrange(1, data.shape[1]):
+        total += data[:, frame]
+    return total
+
+def get_lstsq_batch(x, y):
+    """solves best fitting line for every row of x and y at once
+    using the closed form least squares solution
+
+    Parameters
+    ----------
+    x : numpy array
+        array of shape (nvoxels, nframes)
+    y : numpy array
+        array of shape (nvoxels, nframes)
+
+    Returns
+    -------
+    slope, intercept, residues : numpy arrays
+        each of shape (nvoxels,), rows where x or y are all zero
+        are set to 0 (as in get_lstsq), float32 if x and y are
+
+    means and sums of squares are accumulated in float64 one frame
+    at a time, so no (nvoxels, nframes) temporaries are made
+    """
+    nframes = x.shape[-1]
+    xmean = sum_frames(x) / nframes
+    ymean = sum_frames(y) / nframes
+    sxx = np.zeros(x.shape[0])
+    sxy = np.zeros(x.shape[0])
+    syy = np.zeros(x.shape[0])
+    for frame in xrange(nframes):
+        dx = x[:, frame] - xmean
+        dy = y[:, frame] - ymean
+        sxx += dx * dx
+        sxy += dx * dy
+        syy += dy * dy
+    del dx, dy
+    valid = np.logical_and(np.any(x != 0, axis=-1),
+                           np.any(y != 0, axis=-1))
+    valid = np.logical_and(valid, sxx > 0)
+    slope = np.zeros(x.shape[0])
+    slope[valid] = sxy[valid] / sxx[valid]
+    intercept = np.where(valid, ymean - slope * xmean, 0.)
+    residues = np.where(valid, syy - slope * sxy, 0.)
+    # rounding can leave tiny negative values for perfect fits
+    residues = np.clip(residues, 0, None)
+    dtype = float_dtype(x, y)
+    return (slope.astype(dtype, copy=False),
+            intercept.astype(dtype, copy=False),
+            residues.astype(dtype, copy=False))
+
+
+def timing_array(timing):
+    """ returns timing as the array used by calc_ki, columns
+    (start, duration, stop) in seconds, given a frametime.FrameTime
+    arrays are returned unchanged"""
+    if isinstance(timing, frametime.FrameTime):
+        data = timing.get_data('sec')
+        return np.column_stack([data[:, timing.start],
+                                data[:, timing.duration],
+                                data[:, timing.stop]])
+    return timing
+
+@instrument.instrumented()
 def calc_ki(x,y, timing, range=(35,90)):
     """ calculates ki of data given reference, timing file,
-    and range of steady state data (in minutes)"""
+    and range of steady state data (in minutes)
+
+    timing is a frametime.FrameTime or an array as
+    returned by timing_array
+    voxelwise data (x, y of shape (nvoxels, nframes)) are fit
+    all at once with get_lstsq_batch"""
+    timing = timing_array(timing)
     start_end = np.logical_and(timing[1:,0] / 60. >= range[0],
                                timing[1:,2] / 60. <= range[1])
     if len(x.shape) == len(y.shape) == 1:
@@ -198,81 +901,430 @@ def calc_ki(x,y, timing, range=(35,90)):
         allki, allvd, residues = get_lstsq(x[start_end],y[start_end])
         return allki, allvd, residues
     else:    
-        allki = np.zeros(x.shape[0])
-        resids = np.zeros(x.shape[0])
-        for val, (tmpx, tmpy) in enumerate(zip(x,y)):
-            ki,vd,residues = get_lstsq(tmpx[start_end],tmpy[start_end])
-            allki[val] = ki
-            resids[val] = residues
-            allvd = None
+        allki, allvd, resids = get_lstsq_batch(x[:, start_end],
+                                               y[:, start_end])
+    return allki, allvd, resids
+
+def shared_array(shape, dtype=np.float64):
+    """ returns a float64 (or float32) numpy array of shape backed by
+    shared memory, forked worker processes see the same buffer
+    without copying"""
+    size = int(np.prod(shape))
+    dtype = np.dtype(dtype)
+    typecode = {np.dtype(np.float64): 'd', np.dtype(np.float32): 'f'}[dtype]
+    raw = multiprocessing.sharedctypes.RawArray(typecode, max(size, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+# set in each worker of calc_ki_parallel's pool (inherited on fork)
+_shard_state = {}
+
+def _init_shard_worker(masked_dat, results, ref, midtimes, timing,
+                       k2ref, range):
+    _shard_state.update(masked_dat=masked_dat, results=results, ref=ref,
+                        midtimes=midtimes, timing=timing, k2ref=k2ref,
+                        range=range)
+
+def _fit_shard(bounds):
+    """ fits voxels start:stop of the shared data, writing
+    ki, vd and residuals into the shared results"""
+    start, stop = bounds
+    state = _shard_state
+    x, y = calc_xy(state['ref'], state['masked_dat'][start:stop],
+                   state['midtimes'], state['k2ref'])
+    ki, vd, resids = calc_ki(x, y, state['timing'], range=state['range'])
+    state['results'][0, start:stop] = ki
+    state['results'][1, start:stop] = vd
+    state['results'][2, start:stop] = resids
+
+@instrument.instrumented()
+def calc_ki_parallel(ref, masked_dat, midtimes, timing, k2ref=.15,
+                     range=(35,90), nprocs=None, nshards=None):
+    """ calc_xy and calc_ki on masked data (see mask_data) split in
+    shards of voxels fit in a pool of nprocs worker processes
+    (default: number of cpus)
+
+    the masked data are placed in shared memory once, workers read
+    their shard and write results in place, so nothing voxel sized
+    is pickled. Results are identical to
+    calc_ki(*calc_xy(ref, masked_dat, midtimes, k2ref), timing, range)
+    float32 masked data are shared and fit in float32
+
+    Returns
+    -------
+    allki, allvd, resids : numpy arrays
+        each of shape (nvoxels,), in the voxel order of masked_dat
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if nshards is None:
+        nshards = nprocs * 4
+    nvox = masked_dat.shape[0]
+    dtype = float_dtype(masked_dat)
+    shared = shared_array(masked_dat.shape, dtype)
+    shared[:] = masked_dat
+    results = shared_array((3, nvox), dtype)
+    edges = np.linspace(0, nvox, num=min(nshards, nvox) + 1).astype(int)
+    bounds = zip(edges[:-1], edges[1:])
+    pool = multiprocessing.Pool(nprocs, initializer=_init_shard_worker,
+                                initargs=(shared, results, ref, midtimes,
+                                          timing, k2ref, range))
+    try:
+        pool.map(_fit_shard, bounds, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    allki, allvd, resids = np.array(results)
+    return allki, allvd, resids
+
+@instrument.instrumented()
+def calc_ki_k2ref(ref, masked_dat, midtimes, timing, k2refs,
+                  range=(35,90), int_ref=None):
+    """ Logan fit of masked data for each k2ref in k2refs
+
+    x = int_ref / data + (1 / k2ref) * ref / data, so the integrals
+    and the sums over the steady state frames of the two x terms,
+    y and their products are computed once, and each k2ref only
+    costs a closed form fit per voxel (see fit_from_sums)
+
+    Returns
+    -------
+    allki, allvd, resids : numpy arrays
+        each of shape (len(k2refs), nvoxels), the same as calc_xy with
+        each k2ref followed by calc_ki, use results_to_array on each
+        row to make DVR maps
+    """
+    timing = timing_array(timing)
+    start_end = np.logical_and(timing[1:,0] / 60. >= range[0],
+                               timing[1:,2] / 60. <= range[1])
+    if int_ref is None:
+        int_ref = integrate_reference(ref, midtimes)
+    dat = masked_dat[:, 1:][:, start_end]
+    y = integrate_frames(masked_dat, midtimes)[:, start_end]
+    y /= dat
+    int_term = np.divide(int_ref[1:][start_end], dat, dtype=y.dtype)
+    ref_term = np.divide(ref[1:][start_end], dat, dtype=y.dtype)
+    del dat
+    nframes = y.shape[1]
+    means = [sum_frames(term) / nframes for term in (int_term, ref_term, y)]
+    for term, mean in zip((int_term, ref_term, y), means):
+        term -= mean[:, np.newaxis]
+    int_mean, ref_mean, ymean = means
+    s_ii = sum_frames(int_term * int_term)
+    s_ir = sum_frames(int_term * ref_term)
+    s_rr = sum_frames(ref_term * ref_term)
+    s_iy = sum_frames(int_term * y)
+    s_ry = sum_frames(ref_term * y)
+    s_yy = sum_frames(y * y)
+    valid = np.logical_and(np.any(int_term != 0, axis=-1),
+                           np.any(y != 0, axis=-1))
+    del int_term, ref_term, y
+    shape = (len(k2refs), masked_dat.shape[0])
+    allki = np.zeros(shape)
+    allvd = np.zeros(shape)
+    resids = np.zeros(shape)
+    for val, k2ref in enumerate(k2refs):
+        scale = 1. / k2ref
+        slope, intercept, residues, r2 = fit_from_sums(
+            nframes, 0., 0., s_ii + 2 * scale * s_ir + scale ** 2 * s_rr,
+            s_iy + scale * s_ry, s_yy)
+        intercept = ymean - slope * (int_mean + scale * ref_mean)
+        allki[val] = np.where(valid, slope, 0.)
+        allvd[val] = np.where(valid, intercept, 0.)
+        resids[val] = np.where(valid, residues, 0.)
     return allki, allvd, resids
 
-def results_to_array(results, mask):
+def fit_from_sums(n, sx, sy, sxx, sxy, syy):
+    """ least squares line fit from the sums over n points of
+    x, y, x**2, x*y and y**2 (arrays of any matching shape)
+
+    Returns
+    -------
+    slope, intercept, residues, r2 : numpy arrays
+        fits with no spread in x or y are set to 0
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cxx = sxx - sx * sx / n
+        cxy = sxy - sx * sy / n
+        cyy = syy - sy * sy / n
+        valid = np.logical_and(cxx > 0, cyy > 0)
+        slope = np.where(valid, cxy / cxx, 0.)
+        intercept = np.where(valid, (sy - slope * sx) / n, 0.)
+        residues = np.where(valid, np.clip(cyy - slope * cxy, 0, None), 0.)
+        r2 = np.where(valid, 1 - residues / cyy, 0.)
+    return slope, intercept, residues, r2
+
+def calc_tstar(x, y, timing, stop=90, min_frames=3, min_r2=0.99):
+    """ fits every candidate steady state window at once, to select
+    the start of the linear part of the plot (t*)
+
+    Each frame (with at least min_frames frames up to stop) is a
+    candidate start, and is fit through the last frame ending
+    before stop (in minutes). All candidates are fit from reverse
+    cumulative sums of x, y, x*y, x**2 and y**2 (one pass over the
+    data), instead of one lstsq per candidate
+
+    Parameters
+    ----------
+    x, y : numpy arrays
+        regional (nframes,) or voxelwise (nvoxels, nframes), as
+        from region_xy or calc_xy
+    timing : numpy array or frametime.FrameTime
+        see calc_ki
+    stop : float
+        end of the steady state window (minutes)
+    min_frames : int
+        minimum number of frames in a window
+    min_r2 : float
+        windows with r2 >= min_r2 count as linear
+
+    Returns
+    -------
+    starts : numpy array
+        (ncandidates,) start time (minutes) of each candidate window
+    slopes, intercepts, r2 : numpy arrays
+        (ncandidates,) or (nvoxels, ncandidates) fit of each window
+    best : int or numpy array
+        index of the earliest linear window for the region (or
+        each voxel), -1 if no window is linear
+    """
+    timing = timing_array(timing)
+    regional = len(x.shape) == 1
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
+    ends = np.flatnonzero(timing[1:, 2] / 60. <= stop)
+    last = ends[-1] if ends.size else -1
+    ncand = last + 2 - min_frames
+    if ncand < 1:
+        raise ValueError('fewer than %d frames before %s min'%(min_frames,
+                                                                stop))
+    # shift by the last frame to keep the sums well conditioned
+    x0 = x[:, last:last + 1]
+    y0 = y[:, last:last + 1]
+    dx = x[:, :last + 1] - x0
+    dy = y[:, :last + 1] - y0
+    def reverse_cumsum(data):
+        return np.cumsum(data[:, ::-1], axis=1)[:, ::-1][:, :ncand]
+    n = (last + 1 - np.arange(ncand)).astype(float)
+    slopes, intercepts, resid, r2 = fit_from_sums(
+        n, reverse_cumsum(dx), reverse_cumsum(dy), reverse_cumsum(dx * dx),
+        reverse_cumsum(dx * dy), reverse_cumsum(dy * dy))
+    intercepts = intercepts + y0 - slopes * x0
+    linear = r2 >= min_r2
+    best = np.where(linear.any(axis=1), linear.argmax(axis=1), -1)
+    starts = timing[1:ncand + 1, 0] / 60.
+    if regional:
+        return starts, slopes[0], intercepts[0], r2[0], best[0]
+    return starts, slopes, intercepts, r2, best
+
+@instrument.instrumented()
+def results_to_array(results, mask, shape=None, out=None):
     """ puts values in results back in fill data array
-    of size shape using values in boolean mask"""
-    dat = np.zeros(mask.shape)
-    dat[mask] = results
-    return dat
+    of size shape using values in boolean mask
+
+    mask can also be a flat (C order) voxel index as returned by
+    mask_index (and mask_data), in which case shape (or out) must be
+    given, a ValueError is raised otherwise
+    if out is given, results are scattered into it in place,
+    otherwise the array is float32 for float32 results"""
+    if out is None:
+        if shape is None:
+            if not mask.dtype == np.bool_:
+                raise ValueError('shape (or out) is needed to put results '
+                                 'back with a voxel index')
+            shape = mask.shape
+        out = np.zeros(shape, dtype=float_dtype(results))
+    if mask.dtype == np.bool_:
+        out[mask] = results
+    else:
+        np.put(out, mask, results)
+    return out
+
+def mask_index(mask):
+    """ given a boolean (or nonzero) 3D mask array, return
+    flat (C order) int32 index of voxels in mask"""
+    return np.flatnonzero(mask).astype(np.int32)
+
+def block_size(nframes, memory_budget=DEFAULT_MEMORY_BUDGET, itemsize=8):
+    """ number of voxels to process at once so the voxel-by-frame
+    working arrays of one block (data, x, y and the fit
+    temporaries) stay within memory_budget (in bytes)"""
+    per_voxel = BLOCK_ARRAYS * nframes * itemsize
+    return max(1, int(memory_budget // per_voxel))
+
+@instrument.instrumented()
+def calc_ki_blocks(mask, dat4d, ref, midtimes, timing, k2ref=.15,
+                   range=(35,90), memory_budget=DEFAULT_MEMORY_BUDGET,
+                   dtype=np.float64):
+    """ runs mask_data, calc_xy and calc_ki over masked voxels in blocks
+    so that only one block of voxel-by-frame arrays is in memory at once
+
+    Parameters
+    ----------
+    mask : str or numpy array
+        mask file or 3D array, voxels > 0 are fit
+    dat4d : numpy array
+        4D data (x, y, z, frames)
+    ref : numpy array
+        reference TAC (see get_ref)
+    midtimes : numpy array
+        frame midtimes (sec)
+    timing : numpy array
+        timing array passed on to calc_ki
+    k2ref : float
+        k2 of reference region
+    range : tuple
+        range of steady state data (in minutes)
+    memory_budget : int
+        bytes available for per-block working arrays, sets the block size
+    dtype : numpy dtype
+        np.float32 holds blocks and maps in float32, so blocks of
+        twice as many voxels fit in memory_budget (see FLOAT32_RTOL)
+
+    Returns
+    -------
+    ki, vd, resids : numpy arrays
+        3D maps, voxels outside mask (or with a zero frame) are 0
+        results do not depend on the block size
+    """
+    shape = dat4d.shape[:-1]
+    dtype = np.dtype(dtype)
+    index = roi_index(mask, shape)
+    nblock = block_size(dat4d.shape[-1], memory_budget, dtype.itemsize)
+    allki = np.zeros(shape, dtype=dtype)
+    allvd = np.zeros(shape, dtype=dtype)
+    resids = np.zeros(shape, dtype=dtype)
+    for start in xrange(0, index.size, nblock):
+        dat, block_index = masked_voxels(dat4d, index[start:start + nblock])
+        if block_index.size == 0:
+            continue
+        dat = dat.astype(dtype, copy=False)
+        x, y = calc_xy(ref, dat, midtimes, k2ref)
+        del dat
+        ki, vd, res = calc_ki(x, y, timing, range=range)
+        del x, y
+        results_to_array(ki, block_index, out=allki)
+        results_to_array(vd, block_index, out=allvd)
+        results_to_array(res, block_index, out=resids)
+    return allki, allvd, resids
 
 def loganplot(ref,region, timing, outdir):
     """given (ref), and  (region)
-    calculate best fit line"""
-    midtimes = timing.get_midtimes()
+    calculate best fit line, timing is a frametime.FrameTime
+    the plot is drawn by viewer.logan_plot, returns the figure name,
+    None if figures are off"""
+    midtimes = timing.get_midtimes('sec')[:, 1]
     refx, refy = region_xy(ref, ref, midtimes)
     rx,ry = region_xy(ref, region, midtimes)
     slope, intercept, err = calc_ki(rx,ry, timing)
     refslope, refintercept, referr = calc_ki(refx, refy, timing)
-    fity = rx * slope + intercept
-    fitrefy = refx * refslope + refintercept
-    fig = plt.figure() 
-    fig.set_label('Logan Plot')
-    ax1 = fig.add_subplot(111)
-
-    ax1.plot(rx, ry, 'ro', label = 'pibindex')
-    ax1.plot(refx, refy, 'bo', label = 'ref region')
-    ax1.plot(rx, fity, 'k-', label = 'region slope : %2.2f'%slope)
-    ax1.plot(refx, fitrefy, 'b-', label='ref slope : %2.2f'%refslope)
-    ax1.legend(loc='lower right')
-    ax1.set_ylabel('$\int data / data$')
-    ax1.set_xlabel('$(\int ref / data) + (1 / k2rf) * t / data$')
     outfile = os.path.join(outdir, 'loganplot.png')
-    plt.savefig(outfile)
-    plt.clf()
+    if viewer.render(viewer.logan_plot, rx, ry, refx, refy,
+                     (slope, intercept), (refslope, refintercept), outfile):
+        return outfile
 
 
 def region_xy(ref, region, midtimes, k2ref = .15):
     """ used to calc cumulative integral
-    for one dimensional region"""
-    int_dat = scipy.integrate.cumtrapz(region,midtimes,axis=0) 
-    int_ref = scipy.integrate.cumtrapz(ref.squeeze(), midtimes, axis=0)
+    for one dimensional region, the Logan x and y terms of frames 1 on
+    (same as calc_xy of one voxel)"""
+    ref = ref.squeeze()
+    int_dat = integrate_reference(region, midtimes)[1:]
+    int_ref = integrate_reference(ref, midtimes)[1:]
     y = int_dat / region[1:]
-    x = (int_ref / region[1:]) + ( 1 / k2ref) *(midtimes[1:] / region[1:])
+    x = (int_ref / region[1:]) + ( 1 / k2ref) *(ref[1:] / region[1:])
     return x, y
 
 
+@instrument.instrumented()
 def get_labelroi_data(data, labelf, labels):
     """ given a 4d volume of data (array), a 3d file with label rois
     and a set of labels, extract mean of data (made from combining
     labels)
     """
-    labeldat = label_mask(labelf, labels)
-    assert data.shape[:3] == labeldat.shape
-    means = np.zeros(data.shape[3])
-    for val,slice in enumerate(data.T):
-        ind = np.logical_and(slice > 0,
-                             labeldat.T > 0)
-        means[val] = slice[ind].mean()
-    return means
+    labels, means, counts = label_tacs(data, labelf, labels)
+    return group_tac(labels, means, counts, labels)
 
 def label_mask(labelf, labels):
     """ given a label image and a set of labels
     return the combined label mask"""
     dat = ni.load(labelf).get_data()
-    new = np.zeros(dat.shape)
-    for label in labels:
-        new[dat == label] = 1
+    new = np.in1d(dat, labels).reshape(dat.shape).astype(float)
     return new
 
+def label_tacs(data, labelf, labels=None, sums=False):
+    """ extracts the TAC of every label in a label image in one pass
+    over the frames of data
+
+    Parameters
+    ----------
+    data : numpy array or Frames4D
+        4D data (x, y, z, frames)
+    labelf : str or numpy array
+        3D label image file (eg aparc) or array
+    labels : list
+        labels to extract, default is all nonzero labels in labelf
+    sums : bool
+        if True also return the sum of voxel values for each label
+
+    Returns
+    -------
+    labels : numpy array
+        (nlabels,) sorted labels, the rows of the following arrays
+    means : numpy array
+        (nlabels, nframes) mean of voxels > 0 in each frame (nan
+        voxels are excluded), nan where a label has no such voxels
+    counts : numpy array
+        (nlabels, nframes) number of voxels > 0 in each frame
+    sums : numpy array
+        (nlabels, nframes) only if sums is True
+    """
+    if isinstance(labelf, basestring):
+        labeldat = ni.load(labelf).get_data().squeeze()
+    else:
+        labeldat = np.asarray(labelf)
+    if not labeldat.shape == data.shape[:3]:
+        raise IOError('shape mismatch, labels: %s and data: %s'%(
+            labeldat.shape, data.shape[:3]))
+    labeldat = labeldat.ravel()
+    if labels is None:
+        labels = np.unique(labeldat)
+        labels = labels[labels != 0]
+    labels = np.unique(labels)
+    index = np.flatnonzero(np.in1d(labeldat, labels))
+    # row of each labelled voxel in the outputs
+    rows = np.searchsorted(labels, labeldat[index])
+    nlabels = labels.shape[0]
+    nframes = data.shape[-1]
+    label_sums = np.zeros((nlabels, nframes))
+    counts = np.zeros((nlabels, nframes), dtype=int)
+    coords = np.unravel_index(index, data.shape[:3])
+    for frame in xrange(nframes):
+        vals = data[..., frame][coords]
+        with np.errstate(invalid='ignore'):
+            positive = vals > 0
+        label_sums[:, frame] = np.bincount(rows,
+                                           weights=np.where(positive, vals, 0),
+                                           minlength=nlabels)
+        counts[:, frame] = np.bincount(rows, weights=positive,
+                                       minlength=nlabels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = label_sums / counts
+    if sums:
+        return labels, means, counts, label_sums
+    return labels, means, counts
+
+def group_tac(labels, means, counts, group):
+    """ given the output of label_tacs, returns the (frames,) TAC of the
+    region made from combining the labels in group (eg PIB_INDEX_LABELS)
+    without another pass over the data"""
+    rows = np.in1d(labels, group)
+    counts = counts[rows]
+    sums = np.where(counts > 0, means[rows] * counts, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums.sum(axis=0) / counts.sum(axis=0)
 
 
 def generate_region(data, labels):
@@ -299,36 +1351,23 @@ if __name__ == '__main__':
     refroifile = '%s/rgrey_cerebellum.nii.gz'%root
     mask = '%s/rbrainmask.nii.gz'%root
     timing_file = '%s/frametimes.csv'%root
-    aparc = '%s/rB09-210_v1_aparc_aseg.nii.gz'%rooti
-    pibtimes = frametimes.FrameTime().from_csv(timing_file, units = 'sec')
-    midtimes = pibtimes.get_midtimes()
+    aparc = '%s/rB09-210_v1_aparc_aseg.nii.gz'%root
+    pibtimes = frametime.FrameTime().from_csv(timing_file, units = 'sec')
+    midtimes = pibtimes.get_midtimes('sec')[:, 1]
+    viewer.start_renderer()
     data4d = get_data_nibabel(frames)
     
     ref = get_ref(refroifile, data4d)
-    ref_fig = save_inputplot(ref, (midtimes + durs/2.), root)
+    ref_fig = save_inputplot(ref, midtimes, root)
     masked_data, mask_roi = mask_data(mask, data4d)
-    x,y  = calc_xy(ref,masked_data, midtimes)
+    x,y  = calc_xy(ref,masked_data, midtimes, k2ref=k2ref)
     allki,allvd, residuals = calc_ki(x, y, pibtimes, range=range)
-    dvr = results_to_array(allki, mask_roi)
     # logan plot
-    labels = [1003,
-              1012,1014,1018,1019,1020,1027,1028,1032,1008,
-              1025,1029,1031,1002,1023,1010,1026,2003,
-              2012,2014,2018,2019,2020,2027,2028,2032,2008,
-              2025,2029,2031,2002,2023,2010,2026,1015,1030,
-              2015,2030,2009,1009]
-
-    region_x =  get_labelroi_data(data4d, aparc, labels)
-    
-    loganplot(ref,region_x, timing_file, root)
-    save_data2nii(dvr, mask, filename='DVR', outdir=root)
-    
-    
-
-
-            
+    region_x =  get_labelroi_data(data4d, aparc, PIB_INDEX_LABELS)
     
-            
-            
-        
-        
+    loganplot(ref,region_x, pibtimes, root)
+    with NiftiWriter(mask, outdir=root, index=mask_roi) as writer:
+        writer.write(allki, filename='DVR')
+        writer.write(allvd, filename='intercept')
+        writer.write(residuals, filename='residuals')
+    viewer.stop_renderer()
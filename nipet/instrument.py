@@ -0,0 +1,239 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Opt-in timing and memory records of pipeline stages
+
+Functions decorated with instrumented (the ga stages, FrameTime
+loaders) and code run inside a stage block produce one record per
+call once instrumentation is enabled
+
+    instrument.enable(logfile='run.jsonl')
+    instrument.set_subject('B12-203')
+    with instrument.stage('my_stage'):
+        ...
+
+a record is a dict with the stage, subject, process id, start time,
+wall and cpu seconds, peak resident memory during the stage, and the
+bytes read and written (from /proc/self/io, linux only; memory-mapped
+reads only show as disk_read_bytes).
+Records are passed to callbacks, or appended as json lines to a log
+file, which also collects records from forked worker processes.
+When disabled (the default) a stage costs one check of a list.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+
+_handlers = []
+_context = {'subject': None}
+_local = threading.local()
+
+IO_FIELDS = {'rchar': 'read_bytes', 'wchar': 'write_bytes',
+             'read_bytes': 'disk_read_bytes',
+             'write_bytes': 'disk_write_bytes'}
+
+
+class JsonLinesLog(object):
+    """ callable handler appending each record as a line of json to
+    filename, each line is written and flushed at once so processes
+    forked after enable can share the log"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.logfile = open(filename, 'a')
+
+    def __call__(self, record):
+        self.logfile.write(json.dumps(record, sort_keys=True) + '\n')
+        self.logfile.flush()
+
+    def close(self):
+        self.logfile.close()
+
+
+def enable(callback=None, logfile=None):
+    """ turns instrumentation on, records are passed to callback
+    and / or appended to logfile (see JsonLinesLog)
+    returns list of handlers added"""
+    added = []
+    if callback is not None:
+        added.append(callback)
+    if logfile is not None:
+        added.append(JsonLinesLog(logfile))
+    if not added:
+        raise IOError('enable needs a callback or logfile')
+    _handlers.extend(added)
+    return added
+
+
+def disable(handler=None):
+    """ removes handler (default all handlers), instrumentation is off
+    once no handlers remain"""
+    if handler is None:
+        removed = list(_handlers)
+    else:
+        removed = [handler]
+    for item in removed:
+        _handlers.remove(item)
+        if isinstance(item, JsonLinesLog):
+            item.close()
+
+
+def is_enabled():
+    """True if records are being made"""
+    return bool(_handlers)
+
+
+def set_subject(subject):
+    """ subject added to all following records (None for no subject)"""
+    _context['subject'] = subject
+
+
+def get_subject():
+    return _context['subject']
+
+
+def _status_bytes(field):
+    """value of field (kB) in /proc/self/status in bytes, None if
+    not available"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """ resets the peak resident set size of this process (linux), so
+    the next peak_rss is the peak since now, returns False if it
+    could not be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def peak_rss():
+    """ peak resident set size (bytes) of this process since start,
+    or since reset_peak_rss"""
+    peak = _status_bytes('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kilobytes on linux, bytes on mac
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return peak
+
+
+def current_rss():
+    """resident set size (bytes) of this process"""
+    rss = _status_bytes('VmRSS')
+    if rss is None:
+        return peak_rss()
+    return rss
+
+
+def io_counters():
+    """ dict of bytes read and written by this process so far
+    (see IO_FIELDS), empty if /proc/self/io is not available"""
+    counters = {}
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                field, value = line.split(':')
+                if field in IO_FIELDS:
+                    counters[IO_FIELDS[field]] = int(value)
+    except IOError:
+        pass
+    return counters
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+class stage(object):
+    """ context manager recording the stage name run inside it
+    (nothing is done unless instrumentation is enabled)
+
+    stages can be nested, peak_rss of an outer stage includes the
+    peaks of the stages inside it
+    extra keyword arguments are added to the record"""
+    def __init__(self, name, **extra):
+        self.name = name
+        self.extra = extra
+        self.active = False
+
+    def __enter__(self):
+        if not _handlers:
+            return self
+        self.active = True
+        stack = _stack()
+        if stack:
+            # keep the parent's peak so far before resetting
+            stack[-1].peak = max(stack[-1].peak, peak_rss())
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        reset_peak_rss()
+        self.peak = 0
+        self.start_rss = current_rss()
+        self.start_io = io_counters()
+        self.start = time.time()
+        self.start_cpu = _cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.active:
+            return False
+        wall = time.time() - self.start
+        cpu = _cpu_seconds() - self.start_cpu
+        self.peak = max(self.peak, peak_rss())
+        end_io = io_counters()
+        stack = _stack()
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        self.active = False
+        record = dict(stage=self.name, subject=_context['subject'],
+                      pid=os.getpid(), start=self.start, wall=wall,
+                      cpu=cpu, peak_rss=self.peak,
+                      rss_increase=max(0, self.peak - self.start_rss),
+                      parent=self.parent, depth=self.depth,
+                      failed=exc_type is not None)
+        for field in end_io:
+            record[field] = end_io[field] - self.start_io.get(field, 0)
+        record.update(self.extra)
+        for handler in list(_handlers):
+            handler(record)
+        return False
+
+
+def instrumented(name=None):
+    """ decorator running the function as a stage (default name is
+    the function name), calls go straight to the function when
+    instrumentation is disabled"""
+    def decorator(func):
+        stage_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _handlers:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,74 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Gjedde-Patlak Graphical Analysis for irreversible tracers,
+using a reference region as input
+
+    y = data / reference
+    x = integrated_reference / reference
+
+the slope of the steady state part of the plot is Ki.
+Frames, steady state window (range) and fitting are the same as
+for Logan (see ga.calc_xy, ga.calc_ki), so both can be computed from
+one load of the data and one integration of the reference
+(see logan_patlak)
+"""
+import numpy as np
+from . import ga
+
+
+def calc_xy(ref, masked_dat, midtimes, int_ref=None):
+    """calculates the x and y terms used in Patlak Graphical Analysis
+    for masked data, shape (nvoxels, nframes)
+
+    Returns
+    -------
+    x : numpy array
+        (nframes - 1,) the same for every voxel
+    y : numpy array
+        (nvoxels, nframes - 1)
+    """
+    if int_ref is None:
+        int_ref = ga.integrate_reference(ref, midtimes)
+    x = int_ref[1:] / ref[1:]
+    y = masked_dat[:, 1:] / ref[1:]
+    return x, y
+
+
+def region_xy(ref, region, midtimes, int_ref=None):
+    """ x and y Patlak terms for a one dimensional region"""
+    if int_ref is None:
+        int_ref = ga.integrate_reference(ref, midtimes)
+    x = int_ref[1:] / ref[1:]
+    y = region[1:] / ref[1:]
+    return x, y
+
+
+def calc_ki(x, y, timing, range=(35,90)):
+    """ calculates Patlak Ki (and intercept, residuals) given x, y
+    from calc_xy or region_xy, timing (see ga.calc_ki)
+    and range of steady state data (in minutes)"""
+    if len(y.shape) > 1:
+        # shared x, fit with the same batched solver as Logan
+        x = np.broadcast_to(x, y.shape)
+    return ga.calc_ki(x, y, timing, range=range)
+
+
+def logan_patlak(ref, masked_dat, midtimes, timing, k2ref=.15,
+                 range=(35,90)):
+    """ Logan DVR and Patlak Ki for the same masked data, sharing
+    the integrated reference
+
+    Returns
+    -------
+    logan, patlak : tuples
+        (slope, intercept, residuals) each of shape (nvoxels,)
+    """
+    int_ref = ga.integrate_reference(ref, midtimes)
+    x, y = ga.calc_xy(ref, masked_dat, midtimes, k2ref=k2ref,
+                      int_ref=int_ref)
+    logan = ga.calc_ki(x, y, timing, range=range)
+    del x, y
+    x, y = calc_xy(ref, masked_dat, midtimes, int_ref=int_ref)
+    patlak = calc_ki(x, y, timing, range=range)
+    return logan, patlak
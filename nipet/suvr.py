@@ -0,0 +1,113 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Standardized uptake value ratio (SUVR)
+
+The frames in a time window are averaged, weighting each by its
+duration, and divided by the same weighted average of the reference
+region TAC (see ga.get_ref).
+Frames are read and summed one at a time, so memory use for input
+files (3D frames or a 4D file, compressed or not) is about two 3D
+volumes whatever the number of frames. Loaded data (an array or a
+Frames4D of a compressed file) are already held in memory.
+"""
+import numpy as np
+import nibabel as ni
+from . import ga
+
+
+def frame_weights(timing, window):
+    """ given a frametime.FrameTime and window (start, stop) in minutes
+    returns array of frame durations (minutes) for frames that lie
+    within window, 0 for all other frames"""
+    data = timing.get_data('min')
+    inwindow = np.logical_and(data[:, timing.start] >= window[0],
+                              data[:, timing.stop] <= window[1])
+    return np.where(inwindow, data[:, timing.duration], 0.)
+
+
+def iter_frames(frames, selected=None):
+    """ yields (frame number, 3D float64 array) one frame at a time,
+    with nan set to 0
+
+    Parameters
+    ----------
+    frames : list, str, Frames4D or numpy array
+        list of 3D files, a 4D file, or loaded 4D data, only one
+        frame of a 4D file is read at a time (also when compressed)
+    selected : list
+        frame numbers (0 based) to read, default is all
+    """
+    if isinstance(frames, basestring):
+        img = ni.load(frames)
+        if not len(img.shape) == 4:
+            raise IOError('%s has shape %s, not 4D'%(frames, img.shape))
+        frames = img.dataobj
+    if isinstance(frames, (list, tuple)):
+        nframes = len(frames)
+    else:
+        nframes = frames.shape[-1]
+    if selected is None:
+        selected = xrange(nframes)
+    for frame in selected:
+        if isinstance(frames, (list, tuple)):
+            dat = np.array(ni.load(frames[frame]).get_data().squeeze(),
+                           dtype=np.float64)
+            np.nan_to_num(dat, copy=False)
+        elif isinstance(frames, ga.Frames4D):
+            dat = frames.frame(frame)
+        else:
+            dat = np.nan_to_num(np.array(frames[..., int(frame)],
+                                         dtype=np.float64))
+        yield frame, dat
+
+
+def calc_suvr(frames, timing, refroi, window=(50,70)):
+    """ SUVR of frames in window
+
+    Parameters
+    ----------
+    frames : list, str, Frames4D or numpy array
+        list of 3D files, a 4D file, or loaded 4D data (see iter_frames)
+    timing : frametime.FrameTime
+        timing of frames
+    refroi : str or numpy array
+        reference region file or array (see ga.get_ref)
+    window : tuple
+        (start, stop) in minutes, frames within window are used
+
+    Returns
+    -------
+    suvr : numpy array
+        3D SUVR map
+    refmean : float
+        duration weighted mean of the reference TAC in window
+    """
+    weights = frame_weights(timing, window)
+    selected = np.flatnonzero(weights)
+    if selected.size == 0:
+        raise IOError('no frames in window %s'%(window,))
+    total = None
+    ref_total = 0.
+    for frame, dat in iter_frames(frames, selected):
+        if total is None:
+            coords = np.unravel_index(ga.roi_index(refroi, dat.shape),
+                                      dat.shape)
+            total = np.zeros(dat.shape)
+        # reference mean as in ga.get_ref, voxels > 0 only
+        refvals = dat[coords]
+        ref_total += weights[frame] * refvals[refvals > 0].mean()
+        dat *= weights[frame]
+        total += dat
+        del dat
+    refmean = ref_total / weights.sum()
+    total /= weights.sum() * refmean
+    return total, refmean
+
+
+def save_suvr(frames, timing, refroi, window=(50,70), filename='SUVR',
+              outdir='.'):
+    """ calculates SUVR (see calc_suvr) and saves it to a nifti file
+    with the affine of refroi (file), returns filename"""
+    suvr, refmean = calc_suvr(frames, timing, refroi, window=window)
+    return ga.save_data2nii(suvr, refroi, filename=filename, outdir=outdir)
@@ -0,0 +1,145 @@
+from unittest import TestCase
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal,
+                           assert_allclose)
+from os.path import exists, join
+import csv
+import json
+import shutil
+import tempfile
+import nibabel as ni
+from .. import ga
+from .. import batch
+from .. import benchmark
+
+
+def make_subject(outdir, subject, shape=(6, 6, 6), nframes=10):
+    """writes frames, reference, mask and timing of a small
+    synthetic subject to outdir, returns manifest row"""
+    affine = np.eye(4)
+    durs = np.ones(nframes) * 600
+    stops = durs.cumsum()
+    starts = stops - durs
+    ref = np.linspace(1, 2, nframes) * 100
+    for val in range(nframes):
+        dat = np.ones(shape) * ref[val] * (1 + np.random.random(shape))
+        ni.Nifti1Image(dat, affine).to_filename(
+            join(outdir, '%s_frame%02d.nii'%(subject, val)))
+    refroi = np.zeros(shape)
+    refroi[:2] = 1
+    ni.Nifti1Image(refroi, affine).to_filename(
+        join(outdir, '%s_ref.nii'%subject))
+    mask = np.zeros(shape)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    ni.Nifti1Image(mask, affine).to_filename(
+        join(outdir, '%s_mask.nii'%subject))
+    with open(join(outdir, '%s_timing.csv'%subject), 'w') as out:
+        out.write('frame,start time,stop time,duration\n')
+        for val in range(nframes):
+            out.write('%d,%d,%d,%d\n'%(val + 1, starts[val], stops[val],
+                                       durs[val]))
+    return dict(subject=subject,
+                frames=join(outdir, '%s_frame*.nii'%subject),
+                refroi=join(outdir, '%s_ref.nii'%subject),
+                mask=join(outdir, '%s_mask.nii'%subject),
+                timing=join(outdir, '%s_timing.csv'%subject),
+                units='sec', outdir=outdir)
+
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.subjects = [make_subject(self.tmpdir, 'B00-%03d'%val)
+                         for val in range(3)]
+        self.manifest = join(self.tmpdir, 'manifest.csv')
+        fields = ['subject', 'frames', 'refroi', 'mask', 'timing',
+                  'units', 'outdir']
+        with open(self.manifest, 'wb') as out:
+            writer = csv.DictWriter(out, fields)
+            writer.writeheader()
+            for subject in self.subjects:
+                writer.writerow(subject)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_manifest(self):
+        subjects = batch.read_manifest(self.manifest)
+        assert_equal(subjects, self.subjects)
+        # rows without the trailing optional columns
+        manifest = join(self.tmpdir, 'short.csv')
+        with open(manifest, 'w') as out:
+            out.write('subject,frames,refroi,mask,timing,aparc,outdir\n')
+            out.write('B00-900,f*.nii,ref.nii,mask.nii,timing.csv\n')
+        subjects = batch.read_manifest(manifest)
+        assert_equal(subjects[0]['aparc'], '')
+        assert_equal(subjects[0]['timing'], 'timing.csv')
+
+    def test_run_batch(self):
+        # break one subject, it is reported not raised
+        subjects = batch.read_manifest(self.manifest)
+        subjects[1]['timing'] = join(self.tmpdir, 'missing.csv')
+        summary = join(self.tmpdir, 'summary.csv')
+        statuses = batch.run_batch(subjects, nprocs=2,
+                                   memory_limit=10 * 1024 ** 2,
+                                   summary=summary)
+        assert_equal([status['status'] for status in statuses],
+                     ['ok', 'failed', 'ok'])
+        assert_equal(exists(statuses[0]['dvr']), True)
+        with open(summary) as infile:
+            rows = list(csv.DictReader(infile))
+        assert_equal([row['subject'] for row in rows],
+                     [subject['subject'] for subject in subjects])
+        # same as running the pipeline in this process
+        expected = batch.run_subject(subjects[2])
+        assert_almost_equal(ni.load(statuses[2]['dvr']).get_data(),
+                            ni.load(expected['dvr']).get_data())
+
+    def test_run_batch_log(self):
+        log = join(self.tmpdir, 'stages.jsonl')
+        batch.run_batch(self.manifest, nprocs=2, log=log)
+        with open(log) as infile:
+            records = [json.loads(line) for line in infile]
+        runs = [record for record in records
+                if record['stage'] == 'run_subject']
+        assert_equal(sorted(record['subject'] for record in runs),
+                     [subject['subject'] for subject in self.subjects])
+        stages = set(record['stage'] for record in records)
+        for stage in ['FrameTime.from_csv', 'load_3d', 'get_ref',
+                      'mask_data', 'calc_xy', 'calc_ki', 'save_data2nii']:
+            assert_equal(stage in stages, True)
+
+    def test_run_subject_float32(self):
+        expected = batch.run_subject(self.subjects[0])
+        subject = dict(self.subjects[0], outdir=join(self.tmpdir, 'float32'))
+        result = batch.run_subject(subject, dtype=np.float32)
+        dvr = ni.load(result['dvr']).get_data()
+        assert_equal(dvr.dtype, np.float32)
+        assert_allclose(dvr, ni.load(expected['dvr']).get_data(),
+                        rtol=ga.FLOAT32_RTOL, atol=1e-6)
+
+    def test_pibindex(self):
+        # phantom TACs are linear in DVR, so the mean TAC of the labels
+        # has the mean DVR of their voxels
+        timing = benchmark.pib_timing()
+        files, dvr = benchmark.make_phantom(self.tmpdir, (12, 12, 12),
+                                            timing, dtype=np.float64)
+        aparc = np.zeros(dvr.shape, dtype=np.int16)
+        aparc[2:6, 3:9, 4:10] = ga.PIB_INDEX_LABELS[0]
+        aparc[6:9, 3:9, 4:10] = ga.PIB_INDEX_LABELS[1]
+        aparc[dvr == 0] = 0
+        aparcfile = join(self.tmpdir, 'aparc.nii')
+        ni.Nifti1Image(aparc, np.eye(4)).to_filename(aparcfile)
+        timingfile = join(self.tmpdir, 'phantom_timing.csv')
+        with open(timingfile, 'w') as out:
+            out.write('frame,start time,stop time,duration\n')
+            for row in timing.get_data('sec'):
+                out.write('%d,%d,%d,%d\n'%tuple(row))
+        subject = dict(subject='phantom', frames=files['data'],
+                       refroi=files['refroi'], mask=files['mask'],
+                       timing=timingfile, units='sec', aparc=aparcfile,
+                       outdir=self.tmpdir)
+        result = batch.run_subject(subject)
+        assert_allclose(result['pibindex'], dvr[aparc > 0].mean(),
+                        rtol=1e-6)
@@ -0,0 +1,64 @@
+from unittest import TestCase
+import copy
+import json
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from os.path import exists, join
+from .. import ga
+from .. import benchmark
+
+
+class TestBenchmark(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unit_tac(self):
+        timing = benchmark.pib_timing()
+        midtimes = timing.get_midtimes('sec')[:, 1]
+        ref = benchmark.reference_tac(midtimes)
+        tac = benchmark.unit_tac(ref, midtimes, tau=10.)
+        x, y = ga.calc_xy(ref, 1.7 * tac[np.newaxis], midtimes)
+        assert_almost_equal(y[0], 1.7 * x[0] - 10.)
+
+    def test_phantom_dvr(self):
+        timing = benchmark.pib_timing()
+        files, truth = benchmark.make_phantom(self.tmpdir, (8, 8, 8),
+                                              timing)
+        dvr, stages = benchmark.run_pipeline(files, timing, self.tmpdir)
+        mask = truth > 0
+        assert_equal(mask.sum() > 0, True)
+        assert_almost_equal(dvr[mask], truth[mask], 5)
+        assert_equal(sorted(stages), sorted(benchmark.STAGES))
+        for measured in stages.values():
+            assert_equal(measured['seconds'] >= 0, True)
+            assert_equal(measured['peak_rss'] > 0, True)
+
+    def test_run_compare(self):
+        benchmark.SIZES['test'] = (6, 6, 6)
+        try:
+            outfile = join(self.tmpdir, 'bench.json')
+            failed = benchmark.main(['run', '--sizes', 'test', '--repeat',
+                                     '1', '--out', outfile,
+                                     '--tmpdir', self.tmpdir])
+        finally:
+            del benchmark.SIZES['test']
+        assert_equal(failed, 0)
+        with open(outfile) as infile:
+            results = json.load(infile)
+        assert_equal(results['sizes']['test']['shape'], [6, 6, 6])
+        assert_equal(benchmark.compare(outfile, outfile), [])
+        slower = copy.deepcopy(results)
+        stage = slower['sizes']['test']['stages']['calc_ki']
+        stage['seconds'] += 1.
+        regressions = benchmark.compare(slower, results)
+        assert_equal(len(regressions), 1)
+        assert_equal(regressions[0]['stage'], 'calc_ki')
+        assert_equal(regressions[0]['metric'], 'seconds')
+        # faster is not a regression
+        assert_equal(benchmark.compare(results, slower), [])
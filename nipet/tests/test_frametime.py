@@ -1,14 +1,20 @@
 from unittest import TestCase, skipIf, skipUnless
 import numpy as np
+import nibabel
 from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
 from os.path import exists, join, split, abspath
 import os
+import shutil
+import tempfile
 from .. import frametime
 from ..frametime import DataError, FrameError
 
 def file_exists(filename):
     return exists(filename) 
 
+TINYPET = join(split(abspath(nibabel.__file__))[0], 'tests', 'data',
+               'tinypet.v')
+
 class TestFrametime(TestCase):
 
     def test_class(self):
@@ -82,6 +88,58 @@ class TestFrametime(TestCase):
         ft.data = frames
         assert_equal(ft._validate_frames(), True)
 
+    def test_validate_frames_all_problems(self):
+        frames = np.array([[1, 0, 5, 5],
+                           [2, 4, 8, 4],
+                           [4, 8, 9, 2],
+                           [5, 9, 1, 10],
+                           [5, 10, 11, 1],
+                           [6, np.nan, np.nan, np.nan]])
+        problems = frametime.validate_frames(frames)
+        assert_equal(problems['valid'], False)
+        assert_equal(problems['nframes'], 6)
+        assert_equal(problems['missing'], [3])
+        assert_equal(problems['overlapping'], [1])
+        assert_equal(problems['unaligned'], [2])
+        assert_equal(problems['swapped'], [3])
+        assert_equal(problems['nonconsecutive'], [4])
+        assert_equal(problems['incomplete'], [5])
+        assert_equal(problems['negative'], [])
+        problems = frametime.validate_frames(np.zeros((3, 2)))
+        assert_equal(problems['columns'], [3, 2])
+        assert_equal(problems['valid'], False)
+        good = np.array([[1, 0, 5, 5],
+                         [2, 5, 8, 3]])
+        assert_equal(frametime.validate_frames(good)['valid'], True)
+        zero_based = np.array([[0, 0, 5, 5],
+                               [1, 5, 10, 5],
+                               [2, 10, 20, 10]])
+        problems = frametime.validate_frames(zero_based)
+        assert_equal(problems['valid'], False)
+        assert_equal(problems['nonconsecutive'], [0])
+        assert_equal(problems['missing'], [])
+        ft = frametime.FrameTime()
+        ft.data = zero_based
+        assert_raises(frametime.FrameError, ft._validate_frames)
+
+    def test_validate_timing_files(self):
+        datadir = join(split(abspath(__file__))[0], 'data')
+        summary = frametime.validate_timing_files(datadir, nprocs=2,
+                                                  pattern='PIBtiming*.csv')
+        assert_equal(len(summary), 14)
+        assert_equal(list(summary.columns), frametime.VALIDATION_FIELDS)
+        # B12-203 is missing frame 34 (blank line)
+        row = summary[summary.file.str.contains('B12-203')].iloc[0]
+        assert_equal(row['valid'], False)
+        assert_equal(row['missing'], [34])
+        row = summary[summary.file.str.contains('B12-317')].iloc[0]
+        assert_equal(row['valid'], True)
+        serial = frametime.validate_timing_files(list(summary.file),
+                                                 nprocs=1)
+        assert_equal(list(serial.valid), list(summary.valid))
+        missing = frametime.validate_timing_files([join(datadir, 'none.csv')])
+        assert_equal(missing.error[0].startswith('IOError'), True)
+
     def test_delete_frame(self):
         ft = frametime.FrameTime()
         ft.set_units('sec')
@@ -117,6 +175,17 @@ class TestFrametime(TestCase):
 
 
 
+    @skipUnless(file_exists(TINYPET), 'nibabel test data not installed')
+    def test_read_ecat_timing(self):
+        num_frames, timing = frametime.read_ecat_timing(TINYPET)
+        assert_equal(num_frames, 1)
+        assert_equal(timing, [[1, 1500, 1800, 300]])
+        # the same series from several files, read in threads
+        ft = frametime.FrameTime()
+        ft.from_ecats([TINYPET, TINYPET], 'sec', nthreads=2)
+        assert_equal(ft.data, timing)
+        assert_equal(ft.get_units(), 'sec')
+
     def test_from_csv(self):
         infile = join(split(abspath(__file__))[0], 'data','sample_frames.csv')
         sample_data = np.array([[1., 0., 15., 15.],
@@ -128,6 +197,48 @@ class TestFrametime(TestCase):
         assert_equal(ft.data, sample_data)
         assert_equal(ft.get_units(), 'sec')
 
+    def test_read_timing_table(self):
+        tmpdir = tempfile.mkdtemp()
+        expected = np.array([[1., 0., 15., 15.],
+                             [2., 15., 30., 15.],
+                             [3., 30., 60., 30.]])
+        tables = {'cr.csv': 'frame,start,stop,duration\r1,0,15,15\r\r'
+                            '2,15,30,15\r3,30,60,30\r',
+                  'tab.txt': '1\t0\t15\t15\n2\t15\t30\t15\n'
+                             '\n3\t30\t60\t30\n',
+                  'swap.csv': 'frame,start,duration,stop\r\n1,0,15,15\r\n'
+                              '2,15,15,30\r\n,,,\r\n3,30,30,60\r\n'}
+        try:
+            for name, table in sorted(tables.items()):
+                filename = join(tmpdir, name)
+                with open(filename, 'wb') as out:
+                    out.write(table)
+                assert_equal(frametime.read_timing_table(filename), expected)
+            raw = frametime.read_timing_table(join(tmpdir, 'swap.csv'),
+                                              correct=False)
+            assert_equal(raw.shape, (4, 4))
+            assert_equal(np.isnan(raw[2]).all(), True)
+            data, offsets, files = frametime.read_timing_dir(tmpdir)
+            assert_equal(files, [join(tmpdir, 'cr.csv'),
+                                 join(tmpdir, 'swap.csv')])
+            assert_equal(offsets, [0, 3, 6])
+            assert_equal(data[offsets[1]:offsets[2]], expected)
+            # swapped minutes, stop - start is not exactly the duration
+            filename = join(tmpdir, 'minutes.txt')
+            with open(filename, 'wb') as out:
+                out.write('1,0,0.1,0.1\n2,0.1,0.2,0.3\n'
+                          '3,0.3,0.4,0.7\n4,0.7,0.4,1.1\n')
+            minutes = np.array([[1., 0., 0.1, 0.1],
+                                [2., 0.1, 0.3, 0.2],
+                                [3., 0.3, 0.7, 0.4],
+                                [4., 0.7, 1.1, 0.4]])
+            assert_equal(frametime.read_timing_table(filename), minutes)
+            ft = frametime.FrameTime()
+            ft.from_csv(filename, 'min')
+            assert_equal(ft.data, minutes)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_from_excel(self):
         infile = join(split(abspath(__file__))[0], 'data','sample_frames.xls')
         sample_data = np.array([[1., 0., 15., 15.],
@@ -253,3 +364,24 @@ class TestFrametime(TestCase):
                              [4, 52.5],
                              [5, 75]])
         assert_equal(midtimes, expected)
+
+    def test_cached_views(self):
+        sample_data = np.array([[1., 0., 15., 15.],
+                                [2., 15., 30., 15.],
+                                [3., 30., 60., 30.]])
+        ft = frametime.FrameTime().from_array(sample_data, 'sec')
+        midtimes = ft.get_midtimes('min')
+        assert_equal(midtimes, [[1, 0.125], [2, 0.375], [3, 0.75]])
+        # repeated calls return the same read-only array
+        assert_equal(ft.get_midtimes('min') is midtimes, True)
+        assert_equal(ft.to_min() is ft.to_min(), True)
+        assert_equal(midtimes.flags.writeable, False)
+        assert_equal(ft.to_sec().flags.writeable, False)
+        assert_equal(ft.get_stop_times('min'), [[1, 0.25], [2, 0.5],
+                                                [3, 1.]])
+        # changing data clears the cache
+        ft.delete_frame(0)
+        assert_equal(ft.get_midtimes('min'), [[2, 0.375], [3, 0.75]])
+        ft.set_units('min')
+        assert_equal(ft.get_start_times('sec'), [[2, 900.], [3, 1800.]])
+
@@ -0,0 +1,92 @@
+from unittest import TestCase
+import json
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from os.path import exists, join
+from .. import ga
+from .. import instrument
+
+
+class TestInstrument(TestCase):
+
+    def setUp(self):
+        self.records = []
+        instrument.set_subject(None)
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.set_subject(None)
+
+    def test_disabled(self):
+        assert_equal(instrument.is_enabled(), False)
+        with instrument.stage('nothing') as stage:
+            pass
+        assert_equal(stage.active, False)
+        assert_raises(IOError, instrument.enable)
+
+    def test_stage(self):
+        instrument.enable(self.records.append)
+        instrument.set_subject('B00-001')
+        with instrument.stage('outer', extra=1):
+            with instrument.stage('inner'):
+                block = np.ones((1024, 1024, 8))
+            del block
+        inner, outer = self.records
+        assert_equal(inner['stage'], 'inner')
+        assert_equal(inner['parent'], 'outer')
+        assert_equal(inner['depth'], 1)
+        assert_equal(outer['extra'], 1)
+        assert_equal(outer['subject'], 'B00-001')
+        assert_equal(outer['failed'], False)
+        # the outer peak includes the inner one (64MB block)
+        assert_equal(inner['peak_rss'] >= 64 * 1024 ** 2, True)
+        assert_equal(outer['peak_rss'] >= inner['peak_rss'], True)
+        assert_equal(outer['wall'] >= inner['wall'], True)
+        for field in ['wall', 'cpu', 'rss_increase', 'start', 'pid']:
+            assert_equal(field in outer, True)
+        instrument.disable()
+        with instrument.stage('off'):
+            pass
+        assert_equal(len(self.records), 2)
+
+    def test_failed_stage(self):
+        instrument.enable(self.records.append)
+        def fail():
+            with instrument.stage('fails'):
+                raise ValueError('bad')
+        assert_raises(ValueError, fail)
+        assert_equal(self.records[0]['failed'], True)
+
+    def test_instrumented(self):
+        instrument.enable(self.records.append)
+        mask = np.zeros((4, 4, 4))
+        mask[1:3, 1:3, 1:3] = 1
+        dat4d = np.random.random((4, 4, 4, 5)) + 1
+        masked, index = ga.mask_data(mask, dat4d)
+        midtimes = np.arange(5) * 60. + 30
+        ga.calc_xy(masked[0], masked, midtimes)
+        stages = [record['stage'] for record in self.records]
+        assert_equal(stages, ['mask_data', 'integrate_frames', 'calc_xy'])
+        assert_equal(ga.calc_xy.__name__, 'calc_xy')
+
+    def test_logfile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = join(tmpdir, 'stages.jsonl')
+            instrument.enable(logfile=logfile)
+            with instrument.stage('one'):
+                pass
+            with instrument.stage('two'):
+                with open(join(tmpdir, 'out.bin'), 'wb') as out:
+                    out.write('x' * 4096)
+            instrument.disable()
+            with open(logfile) as infile:
+                records = [json.loads(line) for line in infile]
+            assert_equal([record['stage'] for record in records],
+                         ['one', 'two'])
+            if 'write_bytes' in records[1]:
+                assert_equal(records[1]['write_bytes'] >= 4096, True)
+        finally:
+            shutil.rmtree(tmpdir)
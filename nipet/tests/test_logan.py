@@ -1,9 +1,16 @@
 from unittest import TestCase, skipIf, skipUnless
 import numpy as np
-from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+import scipy.integrate
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal,
+                           assert_allclose)
 from os.path import (exists, join, split, abspath)
 import os
+import shutil
+import tempfile
+import nibabel as ni
 from .. import ga
+from .. import patlak
+from .. import frametime
 
 class TestLogan(TestCase):
 
@@ -20,5 +27,699 @@ class TestLogan(TestCase):
         assert_equal(good_logan.timesteps, self.steps)
         assert_equal(good_logan.ref_counts, self.ref)
 
+
+class TestLoganCache(TestCase):
+
+    def setUp(self):
+        nframes = 20
+        durs = np.concatenate([np.ones(8) * 120, np.ones(12) * 420])
+        stops = durs.cumsum()
+        starts = stops - durs
+        data = np.column_stack([np.arange(nframes) + 1, starts,
+                                stops, durs])
+        self.ft = frametime.FrameTime().from_array(data, 'sec')
+        self.timing = np.column_stack([starts, durs, stops])
+        self.midtimes = starts + durs / 2.
+        self.ref = np.random.random(nframes) * 100 + 1
+        self.masked = np.random.random((30, nframes)) * 100 + 1
+
+    def test_fits(self):
+        logan = ga.Logan.from_frametime(self.ft, self.ref)
+        assert_equal(logan.timesteps, self.midtimes)
+        assert_equal(logan.timing, self.timing)
+        x, y = ga.calc_xy(self.ref, self.masked, self.midtimes)
+        expected = ga.calc_ki(x, y, self.timing)
+        for res, exp in zip(logan.fit_voxels(self.masked), expected):
+            assert_allclose(res, exp, rtol=1e-12)
+        slope, intercept, resid = logan.fit_region(self.masked[4])
+        assert_almost_equal(slope, expected[0][4])
+        assert_almost_equal(intercept, expected[1][4])
+        x, y, fity = logan.plot_values(self.masked[4])
+        assert_almost_equal(fity, x * slope + intercept)
+
+    def test_cache(self):
+        logan = ga.Logan(self.midtimes, self.ref, timing=self.timing)
+        int_ref = logan.int_ref
+        window = logan.window
+        assert_equal(logan.int_ref is int_ref, True)
+        assert_equal(logan.window is window, True)
+        logan.range = (20, 60)
+        assert_equal(logan.window is window, False)
+        assert_equal(logan.window.sum() < window.sum(), True)
+        slope = logan.fit_region(self.masked[0])[0]
+        logan.k2ref = .2
+        assert_equal(logan.fit_region(self.masked[0])[0] == slope, False)
+        # setting the inputs clears the cache
+        logan.ref_counts = 2 * self.ref
+        assert_equal(logan.int_ref, 2 * int_ref)
+        ref_term = logan.ref_term
+        logan.timesteps = self.midtimes * 2
+        assert_equal(logan.ref_term is ref_term, False)
+        assert_allclose(logan.int_ref, 4 * int_ref)
+        window = logan.window
+        logan.timing = self.ft
+        assert_equal(logan.timing, self.timing)
+        assert_equal(logan.window is window, False)
+        logan.clear_cache()
+        assert_equal(logan._cache, {})
+        assert_raises(IOError, getattr, ga.Logan(self.midtimes, self.ref),
+                      'window')
+
+
+class TestIncrementalLogan(TestCase):
+
+    def setUp(self):
+        nframes = 20
+        durs = np.concatenate([np.ones(8) * 120, np.ones(12) * 420])
+        stops = durs.cumsum()
+        starts = stops - durs
+        self.rows = np.column_stack([np.arange(nframes) + 1, starts,
+                                     stops, durs])
+        self.timing = np.column_stack([starts, durs, stops])
+        self.midtimes = starts + durs / 2.
+        self.dat4d = np.random.random((5, 6, 4, nframes)) * 100 + 1
+        self.dat4d[0, 1, 2, 7] = 0
+        self.mask = np.zeros((5, 6, 4))
+        self.mask[:, 1:5, 1:3] = 1
+        self.refroi = np.zeros((5, 6, 4))
+        self.refroi[1:3, :, 3] = 1
+
+    def test_stream_matches_batch(self):
+        logan = ga.Logan(np.array([]), np.array([]), mask=self.mask,
+                         refroi=self.refroi)
+        assert_raises(IOError, logan.slope)
+        for frame, row in enumerate(self.rows):
+            logan.add_frame(self.dat4d[..., frame], row)
+            provisional = logan.slope_map()
+        ref = ga.get_ref(self.refroi, self.dat4d)
+        assert_almost_equal(logan.ref_counts, ref)
+        assert_almost_equal(logan.timesteps, self.midtimes)
+        allki, allvd, resids = ga.calc_ki_blocks(self.mask, self.dat4d, ref,
+                                                 self.midtimes, self.timing)
+        assert_allclose(provisional, allki, rtol=1e-9, atol=1e-12)
+        masked, index = ga.mask_data(self.mask, self.dat4d)
+        ki, vd, res = logan.slope()
+        assert_allclose(ga.results_to_array(vd, ga.mask_index(self.mask),
+                                            shape=self.mask.shape),
+                        allvd, rtol=1e-9, atol=1e-9)
+        # patlak
+        x, y = patlak.calc_xy(ref, masked, self.midtimes)
+        expected = patlak.calc_ki(x, y, self.timing)[0]
+        assert_allclose(logan.slope_map(patlak=True),
+                        ga.results_to_array(expected, index,
+                                            shape=self.mask.shape),
+                        rtol=1e-9, atol=1e-12)
+
+    def test_stream_needs_empty_start(self):
+        logan = ga.Logan(self.midtimes, np.ones(20))
+        assert_raises(IOError, logan.add_frame, self.dat4d[..., 0],
+                      self.rows[0])
+
+
+class TestCalcKi(TestCase):
+
+    def setUp(self):
+        """ create small voxelwise example data """
+        nframes = 34
+        durs = np.concatenate([np.ones(10) * 60, np.ones(24) * 180])
+        stops = durs.cumsum()
+        starts = stops - durs
+        # columns used by calc_ki: start (sec), duration, stop (sec)
+        self.timing = np.column_stack([starts, durs, stops])
+        self.x = np.random.random((50, nframes - 1)) * 100
+        self.y = 2 * self.x + 3 + np.random.random((50, nframes - 1))
+
+    def test_batch_matches_lstsq(self):
+        allki, allvd, resids = ga.calc_ki(self.x, self.y, self.timing)
+        start_end = np.logical_and(self.timing[1:, 0] / 60. >= 35,
+                                   self.timing[1:, 2] / 60. <= 90)
+        for val, (tmpx, tmpy) in enumerate(zip(self.x, self.y)):
+            ki, vd, res = ga.get_lstsq(tmpx[start_end], tmpy[start_end])
+            assert_almost_equal(allki[val], ki)
+            assert_almost_equal(allvd[val], vd)
+            assert_almost_equal(resids[val], res[0])
+
+    def test_batch_zero_guard(self):
+        self.x[3] = 0
+        self.y[7] = 0
+        allki, allvd, resids = ga.calc_ki(self.x, self.y, self.timing)
+        for val in (3, 7):
+            assert_equal((allki[val], allvd[val], resids[val]), (0, 0, 0))
+
+    def test_fit_from_sums(self):
+        x, y = self.x[:, :10], self.y[:, :10]
+        slope, intercept, resid, r2 = ga.fit_from_sums(
+            10, x.sum(1), y.sum(1), (x * x).sum(1), (x * y).sum(1),
+            (y * y).sum(1))
+        expected = ga.get_lstsq_batch(x, y)
+        assert_almost_equal(slope, expected[0])
+        assert_almost_equal(intercept, expected[1])
+        assert_almost_equal(resid, expected[2])
+
+
+class TestTstar(TestCase):
+
+    def setUp(self):
+        durs = np.concatenate([np.ones(10) * 60, np.ones(24) * 180])
+        stops = durs.cumsum()
+        self.timing = np.column_stack([stops - durs, durs, stops])
+        self.x = np.linspace(1, 100, 33)
+        # linear from frame 12 on, curved before
+        self.y = 0.8 * self.x + 2
+        self.y[:12] -= np.linspace(8, 0.5, 12) ** 2
+
+    def test_candidates(self):
+        starts, slopes, intercepts, r2, best = ga.calc_tstar(
+            self.x, self.y, self.timing, stop=80, min_frames=3,
+            min_r2=0.99999)
+        last = np.flatnonzero(self.timing[1:, 2] / 60. <= 80)[-1]
+        assert_equal(len(starts), last - 1)
+        assert_equal(starts, self.timing[1:last, 0] / 60.)
+        for cand in range(len(starts)):
+            slope, intercept, res = ga.get_lstsq(self.x[cand:last + 1],
+                                                 self.y[cand:last + 1])
+            assert_almost_equal(slopes[cand], slope)
+            assert_almost_equal(intercepts[cand], intercept)
+        assert_equal(best <= 12, True)
+        assert_almost_equal(slopes[best], 0.8, decimal=2)
+        assert_equal(r2[best] >= 0.99999, True)
+        assert_equal(r2[best - 1] < 0.99999, True)
+        # too few frames, or no frame, ending before stop
+        assert_raises(ValueError, ga.calc_tstar, self.x, self.y,
+                      self.timing, stop=self.timing[2, 2] / 60.)
+        assert_raises(ValueError, ga.calc_tstar, self.x, self.y,
+                      self.timing, stop=self.timing[0, 2] / 60.)
+
+    def test_voxelwise(self):
+        x = np.vstack([self.x, self.x, self.x * 2])
+        y = np.vstack([self.y, 0.8 * self.x + 2, self.y])
+        starts, slopes, intercepts, r2, best = ga.calc_tstar(
+            x, y, self.timing, stop=80, min_r2=0.999)
+        regional = ga.calc_tstar(self.x, self.y, self.timing, stop=80,
+                                 min_r2=0.999)
+        assert_equal(best[0], regional[-1])
+        assert_equal(best[1], 0)
+        assert_almost_equal(slopes[0], regional[1])
+        assert_almost_equal(slopes[2], regional[1] / 2.)
+
+
+class TestCalcXY(TestCase):
+
+    def test_matches_repmat(self):
+        midtimes = np.linspace(7.5, 5100, num=34)
+        ref = np.random.random(34) * 1000 + 1
+        masked = np.random.random((20, 34)) * 1000 + 1
+        x, y = ga.calc_xy(ref, masked, midtimes)
+        # original implementation with tiled midtimes and reference
+        big_durs = ga.repmat_1d(midtimes, masked.shape[0])
+        big_ref = ga.repmat_1d(ref, masked.shape[0])
+        int_dat = scipy.integrate.cumtrapz(masked.T, big_durs.T, axis=0)
+        int_ref = scipy.integrate.cumtrapz(big_ref.T, big_durs.T, axis=0)
+        expected_y = int_dat.T / masked[:, 1:]
+        expected_x = (int_ref.T / masked[:, 1:]) + \
+                     (1 / .15) * (big_ref[:, 1:] / masked[:, 1:])
+        assert_equal(x.shape, (20, 33))
+        assert_almost_equal(x, expected_x)
+        assert_almost_equal(y, expected_y)
+
+
+class TestIntegration(TestCase):
+
+    def setUp(self):
+        ga.clear_integration_cache()
+        self.midtimes = np.cumsum(np.random.random(34) * 300)
+
+    def tearDown(self):
+        ga.clear_integration_cache()
+
+    def test_operator(self):
+        operator = ga.integration_operator(self.midtimes)
+        assert_equal(operator.shape, (34, 34))
+        assert_equal(np.triu(operator, 1), 0)
+        assert_equal(operator.flags.writeable, False)
+        tacs = np.random.random((5, 34)) * 100
+        expected = scipy.integrate.cumtrapz(tacs, self.midtimes, axis=1)
+        assert_almost_equal(tacs.dot(operator[1:].T), expected)
+        assert_almost_equal(ga.integrate_frames(tacs, self.midtimes),
+                            expected)
+        assert_almost_equal(ga.integrate_reference(tacs[0], self.midtimes),
+                            np.concatenate([[0], expected[0]]))
+
+    def test_cache(self):
+        operator = ga.integration_operator(self.midtimes)
+        # same protocol, same operator
+        assert_equal(ga.integration_operator(self.midtimes.copy())
+                     is operator, True)
+        for val in range(ga.INTEGRATION_CACHE_SIZE):
+            ga.integration_operator(self.midtimes + val + 1)
+        assert_equal(len(ga._integration_cache), ga.INTEGRATION_CACHE_SIZE)
+        # least recently used protocol was evicted
+        assert_equal(ga.integration_operator(self.midtimes) is operator,
+                     False)
+        ga.clear_integration_cache()
+        assert_equal(len(ga._integration_cache), 0)
+
+
+class TestBlocks(TestCase):
+
+    def setUp(self):
+        nframes = 34
+        durs = np.concatenate([np.ones(10) * 60, np.ones(24) * 180])
+        stops = durs.cumsum()
+        starts = stops - durs
+        self.timing = np.column_stack([starts, durs, stops])
+        self.midtimes = starts + durs / 2.
+        self.dat4d = np.random.random((8, 9, 7, nframes)) * 100 + 1
+        self.dat4d[1, 2, 3, 5] = 0 # voxel excluded by data mask
+        self.mask = np.zeros((8, 9, 7))
+        self.mask[1:7, 2:8, 1:6] = 1
+        self.ref = np.random.random(nframes) * 100 + 1
+
+    def test_results_to_array_index(self):
+        index = ga.mask_index(self.mask)
+        assert_equal(index.dtype, np.int32)
+        vals = np.arange(index.size) + 1.
+        bool_dat = ga.results_to_array(vals, self.mask > 0)
+        index_dat = ga.results_to_array(vals, index, shape=self.mask.shape)
+        assert_equal(index_dat, bool_dat)
+        # an index does not give the image shape
+        assert_raises(ValueError, ga.results_to_array, vals, index)
+        out = np.zeros(self.mask.shape)
+        ga.results_to_array(vals, index, out=out)
+        assert_equal(out, bool_dat)
+
+    def test_mask_data(self):
+        fullmask = np.logical_and(self.mask > 0,
+                                  self.dat4d.all(axis=-1))
+        masked, index = ga.mask_data(self.mask, self.dat4d)
+        assert_equal(index.dtype, np.int32)
+        assert_equal(masked, self.dat4d[fullmask])
+        assert_equal(ga.results_to_array(masked[:, 0], index,
+                                         shape=self.mask.shape),
+                     ga.results_to_array(masked[:, 0], fullmask))
+        assert_raises(IOError, ga.mask_data, self.mask[1:], self.dat4d)
+
+    def test_save_data2nii_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            reference = join(tmpdir, 'mask.nii')
+            ni.Nifti1Image(self.mask, np.eye(4)).to_filename(reference)
+            masked, index = ga.mask_data(reference, self.dat4d)
+            outfile = ga.save_data2nii(masked[:, 3], reference,
+                                       outdir=tmpdir, index=index)
+            expected = ga.results_to_array(masked[:, 3], index,
+                                           shape=self.mask.shape)
+            assert_equal(ni.load(outfile).get_data(), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_nifti_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            reference = join(tmpdir, 'mask.nii')
+            ni.Nifti1Image(self.mask.astype(np.uint8),
+                           np.diag([2., 2., 2., 1.])).to_filename(reference)
+            masked, index = ga.mask_data(reference, self.dat4d)
+            with ga.NiftiWriter(reference, outdir=tmpdir,
+                                index=index) as writer:
+                outfiles = [writer.write(masked[:, frame],
+                                         filename='frame%d'%frame)
+                            for frame in range(3)]
+            for frame, outfile in enumerate(outfiles):
+                img = ni.load(outfile)
+                assert_equal(img.get_data_dtype(), np.float64)
+                assert_equal(img.affine, np.diag([2., 2., 2., 1.]))
+                assert_equal(img.get_data(),
+                             ga.results_to_array(masked[:, frame], index,
+                                                 shape=self.mask.shape))
+            writer = ga.NiftiWriter(reference, outdir=tmpdir, index=index)
+            outfile = writer.write(masked[:, 0].astype(np.float32),
+                                   filename='float32')
+            writer.flush()
+            assert_equal(ni.load(outfile).get_data_dtype(), np.float32)
+            writer.outdir = join(tmpdir, 'missing')
+            writer.write(masked[:, 0])
+            assert_raises(IOError, writer.close)
+            # without an index, maps are whole images
+            writer = ga.NiftiWriter(reference, outdir=tmpdir)
+            dense = writer.write(self.mask, filename='dense')
+            writer.close()
+            assert_equal(ni.load(dense).get_data(), self.mask)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_nifti_writer_header(self):
+        # only the geometry of the reference header is kept
+        tmpdir = tempfile.mkdtemp()
+        try:
+            affine = np.diag([2., 3., 4., 1.])
+            affine[:3, 3] = [-10, 5, 7]
+            img = ni.Nifti1Image(self.mask.astype(np.uint8), affine)
+            img.header.set_qform(affine, 1)
+            img.header.set_sform(affine, 4)
+            img.header.set_xyzt_units('mm', 'sec')
+            img.header['cal_max'] = 1
+            img.header['intent_code'] = 2001
+            img.header['descrip'] = 'brain mask'
+            img.header['aux_file'] = 'lut.txt'
+            reference = join(tmpdir, 'mask.nii')
+            img.to_filename(reference)
+            masked, index = ga.mask_data(reference, self.dat4d)
+            outfile = ga.save_data2nii(masked[:, 0], reference,
+                                       outdir=tmpdir, index=index)
+            header = ni.load(outfile).header
+            assert_equal(header['cal_max'], 0)
+            assert_equal(header['intent_code'], 0)
+            assert_equal(header['descrip'], '')
+            assert_equal(header['aux_file'], '')
+            assert_equal(header.get_zooms(), (2., 3., 4.))
+            assert_equal(header.get_xyzt_units(), ('mm', 'sec'))
+            assert_equal(header.get_qform(coded=True)[1], 1)
+            assert_equal(header.get_sform(coded=True)[1], 4)
+            assert_equal(header.get_best_affine(), affine)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_3d_int16(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dat4d = (self.dat4d * 300).astype(np.int16)
+            infiles = []
+            for frame in range(dat4d.shape[-1]):
+                infile = join(tmpdir, 'frame%02d.nii'%frame)
+                ni.Nifti1Image(dat4d[..., frame],
+                               np.eye(4)).to_filename(infile)
+                infiles.append(infile)
+            loaded = ga.load_3d(infiles)
+            assert_equal(loaded.dtype, np.float64)
+            assert_equal(loaded, dat4d)
+            assert_equal(ga.get_data_nibabel(infiles).dtype, np.float64)
+            # int16 sums of frames would overflow
+            nframes = dat4d.shape[-1]
+            expected = ga.integrate_frames(
+                dat4d.reshape(-1, nframes).astype(np.float64), self.midtimes)
+            assert_equal(ga.integrate_frames(loaded.reshape(-1, nframes),
+                                             self.midtimes), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_block_size(self):
+        assert_equal(ga.block_size(34, 34 * 8 * ga.BLOCK_ARRAYS * 10), 10)
+        assert_equal(ga.block_size(34, 1), 1)
+
+    def test_blocks_match_full(self):
+        fullmask = np.logical_and(self.mask > 0,
+                                  self.dat4d.all(axis=-1))
+        masked = self.dat4d[fullmask]
+        x, y = ga.calc_xy(self.ref, masked, self.midtimes)
+        ki, vd, res = ga.calc_ki(x, y, self.timing)
+        expected = ga.results_to_array(ki, fullmask)
+        nframes = self.dat4d.shape[-1]
+        for nblock in (1, 7, 1000):
+            budget = nblock * nframes * 8 * ga.BLOCK_ARRAYS
+            allki, allvd, resids = ga.calc_ki_blocks(
+                self.mask, self.dat4d, self.ref, self.midtimes,
+                self.timing, memory_budget=budget)
+            assert_equal(allki, expected)
+            assert_equal(allvd, ga.results_to_array(vd, fullmask))
+        assert_equal(allki[1, 2, 3], 0)
+
+    def test_k2ref_sweep(self):
+        masked, index = ga.mask_data(self.mask, self.dat4d)
+        k2refs = [.1, .15, .2]
+        allki, allvd, resids = ga.calc_ki_k2ref(self.ref, masked,
+                                                self.midtimes, self.timing,
+                                                k2refs)
+        assert_equal(allki.shape, (3, masked.shape[0]))
+        for val, k2ref in enumerate(k2refs):
+            x, y = ga.calc_xy(self.ref, masked, self.midtimes, k2ref=k2ref)
+            ki, vd, res = ga.calc_ki(x, y, self.timing)
+            assert_allclose(allki[val], ki, rtol=1e-9)
+            assert_allclose(allvd[val], vd, rtol=1e-9)
+            assert_allclose(resids[val], res, rtol=1e-9)
+
+    def test_parallel_matches_serial(self):
+        fullmask = np.logical_and(self.mask > 0,
+                                  self.dat4d.all(axis=-1))
+        masked = self.dat4d[fullmask]
+        x, y = ga.calc_xy(self.ref, masked, self.midtimes)
+        expected = ga.calc_ki(x, y, self.timing)
+        result = ga.calc_ki_parallel(self.ref, masked, self.midtimes,
+                                     self.timing, nprocs=2, nshards=5)
+        for res, exp in zip(result, expected):
+            assert_equal(res, exp)
+
+
+class TestGetRef(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dat4d = np.random.random((6, 7, 5, 8)) - 0.2
+        self.refdat = np.zeros((6, 7, 5))
+        self.refdat[1:4, 2:5, 1:3] = 1
+        self.refdat[0, 0, 0] = np.nan
+        self.refroi = join(self.tmpdir, 'ref.nii')
+        ni.Nifti1Image(self.refdat, np.eye(4)).to_filename(self.refroi)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_ref(self):
+        # original per frame implementation
+        expected = np.zeros(self.dat4d.shape[-1])
+        refdat = np.nan_to_num(self.refdat)
+        for val, slice in enumerate(self.dat4d.T):
+            ind = np.logical_and(slice > 0, refdat.T > 0)
+            expected[val] = slice[ind].mean()
+        assert_almost_equal(ga.get_ref(self.refroi, self.dat4d), expected)
+        assert_almost_equal(ga.get_ref(self.refdat, self.dat4d), expected)
+        index = ga.roi_index(self.refroi)
+        assert_almost_equal(ga.get_ref(index, self.dat4d), expected)
+        assert_raises(IOError, ga.get_ref, self.refdat[1:], self.dat4d)
+
+    def test_get_ref_nan(self):
+        # nan voxels are excluded, as voxels <= 0
+        dat4d = self.dat4d.copy()
+        dat4d[2, 3, 1, 4] = np.nan
+        dat4d[3, 4, 2, :] = np.nan
+        expected = np.zeros(dat4d.shape[-1])
+        for val in range(dat4d.shape[-1]):
+            vals = dat4d[..., val][self.refdat > 0]
+            expected[val] = vals[vals > 0].mean()
+        result = ga.get_ref(self.refdat, dat4d)
+        assert_equal(np.isnan(result).any(), False)
+        assert_almost_equal(result, expected)
+
+
+class TestLabels(TestCase):
+
+    def setUp(self):
+        self.data = np.random.random((6, 7, 5, 8)) - 0.2
+        self.labeldat = np.random.randint(0, 6, size=(6, 7, 5))
+        self.labeldat[self.labeldat == 4] = 1003
+
+    def test_label_tacs(self):
+        labels, means, counts, sums = ga.label_tacs(
+            self.data, self.labeldat, sums=True)
+        assert_equal(labels, [1, 2, 3, 5, 1003])
+        for row, label in enumerate(labels):
+            for frame in range(self.data.shape[-1]):
+                vals = self.data[..., frame][self.labeldat == label]
+                vals = vals[vals > 0]
+                assert_equal(counts[row, frame], vals.size)
+                assert_almost_equal(sums[row, frame], vals.sum())
+                assert_almost_equal(means[row, frame], vals.mean())
+
+    def test_label_tacs_nan(self):
+        data = self.data.copy()
+        data[self.labeldat == 2] = np.nan
+        data[0, 0, 0, 3] = np.nan
+        labels, means, counts = ga.label_tacs(data, self.labeldat)
+        assert_equal(counts[labels == 2], 0)
+        keep = labels != 2
+        assert_equal(np.isnan(means[keep]).any(), False)
+        for row, label in enumerate(labels[keep]):
+            expected = ga.get_labelroi_data(self.data, self.labeldat,
+                                            [label])
+            if label == self.labeldat[0, 0, 0]:
+                vals = data[..., 3][self.labeldat == label]
+                expected[3] = vals[vals > 0].mean()
+            assert_almost_equal(means[keep][row], expected)
+
+    def test_group_tac(self):
+        labels, means, counts = ga.label_tacs(self.data, self.labeldat,
+                                              labels=[2, 3, 1003, 7])
+        # label 7 is not in labeldat
+        assert_equal(counts[labels == 7], 0)
+        group = [3, 1003, 7]
+        region = ga.group_tac(labels, means, counts, group)
+        labelmask = np.in1d(self.labeldat, group).reshape(
+            self.labeldat.shape)
+        for frame in range(self.data.shape[-1]):
+            vals = self.data[..., frame][labelmask]
+            assert_almost_equal(region[frame], vals[vals > 0].mean())
+
+
+class TestFrames4D(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dat4d = np.random.random((6, 7, 5, 10)) * 100 + 1
+        self.dat4d[1, 1, 1, 4] = np.nan
+        self.affine = np.eye(4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mmap(self):
+        infile = join(self.tmpdir, 'frames.nii')
+        ni.Nifti1Image(self.dat4d, self.affine).to_filename(infile)
+        frames = ga.get_data_nibabel(infile)
+        assert_equal(frames.is_mmap, True)
+        assert_equal(frames.shape, self.dat4d.shape)
+        expected = np.nan_to_num(self.dat4d)
+        assert_equal(frames.frame(4), expected[..., 4])
+        assert_equal(frames.frame(4)[1, 1, 1], 0)
+        coords = (np.array([1, 2]), np.array([1, 3]), np.array([1, 4]))
+        assert_equal(frames[coords], expected[coords])
+        assert_equal(np.asarray(frames), expected)
+        # results do not change the file
+        frames.frame(4)[:] = 0
+        assert_equal(frames.frame(4), expected[..., 4])
+
+    def test_scaled_compressed(self):
+        infile = join(self.tmpdir, 'frames.nii.gz')
+        img = ni.Nifti1Image(np.nan_to_num(self.dat4d).astype(np.int16),
+                             self.affine)
+        img.header.set_slope_inter(0.5, 2)
+        img.to_filename(infile)
+        frames = ga.get_data_nibabel(infile)
+        assert_equal(frames.is_mmap, False)
+        expected = ni.load(infile).get_data()
+        assert_almost_equal(frames.frame(2), expected[..., 2])
+
+    def test_blocks(self):
+        infile = join(self.tmpdir, 'frames.nii')
+        ni.Nifti1Image(self.dat4d, self.affine).to_filename(infile)
+        frames = ga.get_data_nibabel(infile)
+        mask = np.ones(self.dat4d.shape[:3])
+        ref = np.random.random(10) * 100 + 1
+        durs = np.ones(10) * 600
+        stops = durs.cumsum()
+        timing = np.column_stack([stops - durs, durs, stops])
+        midtimes = stops - durs / 2.
+        expected = ga.calc_ki_blocks(mask, np.nan_to_num(self.dat4d), ref,
+                                     midtimes, timing)
+        result = ga.calc_ki_blocks(mask, frames, ref, midtimes, timing,
+                                   memory_budget=10000)
+        assert_equal(result[0], expected[0])
+
+
+
+class TestFloat32(TestCase):
+
+    def setUp(self):
+        # PIB like TACs with a linear Logan plot, plus 1% noise
+        durs = np.array([15] * 4 + [30] * 8 + [60] * 9 + [180] * 2 +
+                        [300] * 10 + [600], dtype=float)
+        stops = durs.cumsum()
+        starts = stops - durs
+        self.timing = np.column_stack([starts, durs, stops])
+        self.midtimes = starts + durs / 2.
+        minutes = self.midtimes / 60.
+        self.ref = 500. * minutes * np.exp(1 - minutes / 2.) + 50.
+        operator = ga.integration_operator(self.midtimes)
+        target = operator.dot(self.ref) + self.ref / .15
+        tac = np.linalg.solve(operator + 10 * np.eye(durs.size), target)
+        shape = (8, 9, 7)
+        dvr = 1 + np.random.random(shape)
+        noise = 1 + 0.01 * np.random.standard_normal(shape + (durs.size,))
+        self.dat4d = dvr[..., np.newaxis] * tac * noise
+        self.mask = np.zeros(shape)
+        self.mask[1:7, 2:8, 1:6] = 1
+
+    def test_pipeline(self):
+        masked, index = ga.mask_data(self.mask, self.dat4d)
+        masked32, index32 = ga.mask_data(self.mask,
+                                         self.dat4d.astype(np.float32))
+        assert_equal(masked32.dtype, np.float32)
+        assert_equal(index32, index)
+        x, y = ga.calc_xy(self.ref, masked, self.midtimes)
+        x32, y32 = ga.calc_xy(self.ref, masked32, self.midtimes)
+        assert_equal((x32.dtype, y32.dtype), (np.float32, np.float32))
+        dvr, vd, resid = ga.calc_ki(x, y, self.timing)
+        dvr32, vd32, resid32 = ga.calc_ki(x32, y32, self.timing)
+        assert_equal(dvr32.dtype, np.float32)
+        assert_allclose(dvr32, dvr, rtol=ga.FLOAT32_RTOL)
+        dvrmap = ga.results_to_array(dvr32, index32, shape=self.mask.shape)
+        assert_equal(dvrmap.dtype, np.float32)
+        # float64 sums of float32 data
+        assert_equal(ga.sum_frames(x32).dtype, np.float64)
+        sweep = ga.calc_ki_k2ref(self.ref, masked32, self.midtimes,
+                                 self.timing, [.15])
+        assert_allclose(sweep[0][0], dvr, rtol=ga.FLOAT32_RTOL)
+
+    def test_blocks_parallel(self):
+        full = ga.calc_ki_blocks(self.mask, self.dat4d, self.ref,
+                                 self.midtimes, self.timing)
+        blocks = ga.calc_ki_blocks(self.mask, self.dat4d, self.ref,
+                                   self.midtimes, self.timing,
+                                   memory_budget=20000, dtype=np.float32)
+        assert_equal(blocks[0].dtype, np.float32)
+        assert_allclose(blocks[0], full[0], rtol=ga.FLOAT32_RTOL)
+        masked32, index = ga.mask_data(self.mask, self.dat4d,
+                                       dtype=np.float32)
+        serial = ga.calc_ki(*ga.calc_xy(self.ref, masked32, self.midtimes),
+                            timing=self.timing)
+        parallel = ga.calc_ki_parallel(self.ref, masked32, self.midtimes,
+                                       self.timing, nprocs=2)
+        assert_equal(parallel[0].dtype, np.float32)
+        assert_equal(parallel[0], serial[0])
+        assert_equal(ga.results_to_array(serial[0], index,
+                                         shape=self.mask.shape),
+                     blocks[0])
+
+    def test_float32_files(self):
+        # float32 files give float64 results unless dtype is float32
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dat4d = self.dat4d.astype(np.float32)
+            infile = join(tmpdir, 'frames.nii')
+            ni.Nifti1Image(dat4d, np.eye(4)).to_filename(infile)
+            infiles = []
+            for frame in range(dat4d.shape[-1]):
+                infiles.append(join(tmpdir, 'frame%02d.nii'%frame))
+                ni.Nifti1Image(dat4d[..., frame],
+                               np.eye(4)).to_filename(infiles[-1])
+            for files in (infiles, infile):
+                for dtype, expected in ((None, np.float64),
+                                        (np.float32, np.float32)):
+                    data = ga.get_data_nibabel(files, dtype=dtype)
+                    masked, index = ga.mask_data(self.mask, data)
+                    assert_equal(masked.dtype, expected)
+                    x, y = ga.calc_xy(self.ref, masked, self.midtimes)
+                    assert_equal(x.dtype, expected)
+                    dvr, vd, resid = ga.calc_ki(x, y, self.timing)
+                    dvrmap = ga.results_to_array(dvr, index,
+                                                 shape=self.mask.shape)
+                    assert_equal(dvrmap.dtype, expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_frames4d(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            infile = join(tmpdir, 'frames.nii')
+            img = ni.Nifti1Image(self.dat4d.astype(np.int16), np.eye(4))
+            img.header.set_slope_inter(0.5, 0)
+            img.to_filename(infile)
+            frames = ga.get_data_nibabel(infile, dtype=np.float32)
+            assert_equal(frames.frame(3).dtype, np.float32)
+            assert_allclose(frames.frame(3),
+                            ni.load(infile).get_data()[..., 3], rtol=1e-7)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,48 @@
+from unittest import TestCase
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from .. import ga
+from .. import patlak
+
+
+class TestPatlak(TestCase):
+
+    def setUp(self):
+        nframes = 34
+        durs = np.concatenate([np.ones(10) * 60, np.ones(24) * 180])
+        stops = durs.cumsum()
+        starts = stops - durs
+        self.timing = np.column_stack([starts, durs, stops])
+        self.midtimes = starts + durs / 2.
+        self.ref = np.random.random(nframes) * 100 + 1
+        int_ref = ga.integrate_reference(self.ref, self.midtimes)
+        # data that are exactly linear on the Patlak plot
+        self.ki = np.random.random(20) * 0.01
+        self.vd = np.random.random(20) + 0.5
+        self.masked = (self.ki[:, np.newaxis] * int_ref +
+                       self.vd[:, np.newaxis] * self.ref)
+
+    def test_voxelwise(self):
+        x, y = patlak.calc_xy(self.ref, self.masked, self.midtimes)
+        assert_equal(x.shape, (33,))
+        assert_equal(y.shape, (20, 33))
+        ki, vd, resids = patlak.calc_ki(x, y, self.timing)
+        assert_almost_equal(ki, self.ki)
+        assert_almost_equal(vd, self.vd)
+        assert_almost_equal(resids, 0)
+
+    def test_regional(self):
+        x, y = patlak.region_xy(self.ref, self.masked[3], self.midtimes)
+        ki, vd, resids = patlak.calc_ki(x, y, self.timing)
+        assert_almost_equal(ki, self.ki[3])
+        assert_almost_equal(vd, self.vd[3])
+
+    def test_logan_patlak(self):
+        logan, ptlk = patlak.logan_patlak(self.ref, self.masked,
+                                          self.midtimes, self.timing)
+        x, y = ga.calc_xy(self.ref, self.masked, self.midtimes)
+        for res, exp in zip(logan, ga.calc_ki(x, y, self.timing)):
+            assert_equal(res, exp)
+        x, y = patlak.calc_xy(self.ref, self.masked, self.midtimes)
+        for res, exp in zip(ptlk, patlak.calc_ki(x, y, self.timing)):
+            assert_equal(res, exp)
@@ -0,0 +1,76 @@
+from unittest import TestCase
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from os.path import join
+import shutil
+import tempfile
+import nibabel as ni
+from .. import ga
+from .. import suvr
+from ..frametime import FrameTime
+
+
+class TestSuvr(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        nframes = 8
+        durs = np.array([5, 5, 10, 10, 10, 10, 5, 5]) * 60.
+        stops = durs.cumsum()
+        data = np.column_stack([np.arange(nframes) + 1, stops - durs,
+                                stops, durs])
+        self.timing = FrameTime().from_array(data, 'sec')
+        self.dat4d = np.random.random((5, 6, 4, nframes)) + 0.1
+        self.refdat = np.zeros((5, 6, 4))
+        self.refdat[:2, :3] = 1
+        self.refroi = join(self.tmpdir, 'ref.nii')
+        ni.Nifti1Image(self.refdat, np.eye(4)).to_filename(self.refroi)
+        self.frames = []
+        for frame in range(nframes):
+            fname = join(self.tmpdir, 'frame%02d.nii'%frame)
+            ni.Nifti1Image(self.dat4d[..., frame],
+                           np.eye(4)).to_filename(fname)
+            self.frames.append(fname)
+        self.frames4d = join(self.tmpdir, 'frames.nii')
+        ni.Nifti1Image(self.dat4d, np.eye(4)).to_filename(self.frames4d)
+        self.frames4dgz = join(self.tmpdir, 'frames.nii.gz')
+        ni.Nifti1Image(self.dat4d, np.eye(4)).to_filename(self.frames4dgz)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_frame_weights(self):
+        weights = suvr.frame_weights(self.timing, (10, 50))
+        assert_equal(weights, [0, 0, 10, 10, 10, 10, 0, 0])
+
+    def test_calc_suvr(self):
+        window = (10, 50)
+        weights = suvr.frame_weights(self.timing, window)
+        mean = (self.dat4d * weights).sum(axis=-1) / weights.sum()
+        ref = ga.get_ref(self.refroi, self.dat4d)
+        refmean = (ref * weights).sum() / weights.sum()
+        for frames in (self.frames, self.frames4d, self.frames4dgz,
+                       self.dat4d):
+            result, resultref = suvr.calc_suvr(frames, self.timing,
+                                               self.refroi, window)
+            assert_almost_equal(resultref, refmean)
+            assert_almost_equal(result, mean / refmean)
+        assert_raises(IOError, suvr.calc_suvr, self.frames, self.timing,
+                      self.refroi, (100, 120))
+        assert_raises(IOError, suvr.calc_suvr, self.refroi, self.timing,
+                      self.refroi, window)
+
+    def test_iter_frames_gz(self):
+        # frames of a compressed 4D file are read one at a time
+        frames = list(suvr.iter_frames(self.frames4dgz, [2, 5]))
+        assert_equal([frame for frame, dat in frames], [2, 5])
+        for frame, dat in frames:
+            assert_equal(dat.dtype, np.float64)
+            assert_almost_equal(dat, self.dat4d[..., frame])
+
+    def test_save_suvr(self):
+        outfile = suvr.save_suvr(self.frames, self.timing, self.refroi,
+                                 (10, 50), outdir=self.tmpdir)
+        expected, refmean = suvr.calc_suvr(self.frames, self.timing,
+                                           self.refroi, (10, 50))
+        assert_almost_equal(ni.load(outfile).get_data(), expected)
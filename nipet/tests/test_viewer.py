@@ -0,0 +1,66 @@
+from unittest import TestCase
+import sys
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from os.path import exists, join, dirname, abspath
+from .. import ga
+from .. import viewer
+
+
+class TestViewer(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        durs = np.ones(34) * 180
+        stops = durs.cumsum()
+        data = np.column_stack([np.arange(1, 35), stops - durs, stops, durs])
+        from .. import frametime
+        self.timing = frametime.FrameTime().from_array(data, 'sec')
+        self.midtimes = self.timing.get_midtimes('sec')[:, 1]
+        self.ref = 100 + 1000 * np.exp(-self.midtimes / 1800.)
+        self.region = 1.5 * self.ref + np.random.random(34)
+
+    def tearDown(self):
+        viewer.stop_renderer()
+        viewer.enable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_lazy_import(self):
+        # a fresh interpreter, this one may have imported pyplot already
+        # (matplotlib itself is imported by pandas)
+        package_dir = dirname(dirname(abspath(ga.__file__)))
+        code = ('import sys, nipet.ga; '
+                'sys.stdout.write(str("matplotlib.pyplot" in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=package_dir)
+        assert_equal(output.strip(), 'False')
+
+    def test_render(self):
+        figname = ga.save_inputplot(self.ref, self.midtimes, self.tmpdir)
+        assert_equal(exists(figname), True)
+        figname = ga.loganplot(self.ref, self.region, self.timing,
+                               self.tmpdir)
+        assert_equal(figname, join(self.tmpdir, 'loganplot.png'))
+        assert_equal(exists(figname), True)
+
+    def test_disabled(self):
+        viewer.disable()
+        assert_equal(ga.save_inputplot(self.ref, self.midtimes,
+                                       self.tmpdir), None)
+        assert_equal(ga.loganplot(self.ref, self.region, self.timing,
+                                  self.tmpdir), None)
+        assert_equal(exists(join(self.tmpdir, 'loganplot.png')), False)
+
+    def test_background(self):
+        viewer.start_renderer(2)
+        figname = ga.loganplot(self.ref, self.region, self.timing,
+                               self.tmpdir)
+        viewer.join()
+        assert_equal(exists(figname), True)
+        # errors are raised by join
+        viewer.render(viewer.input_plot, self.ref, self.midtimes,
+                      join(self.tmpdir, 'missing', 'ref.png'))
+        assert_raises(IOError, viewer.join)
@@ -0,0 +1,130 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+QC figures of TACs and Logan plots
+
+matplotlib is only imported when a figure is drawn, and figures are
+drawn on explicit Figure objects with the Agg canvas (no pyplot
+state), so importing ga costs nothing for workers that draw none.
+
+Figures are drawn through render, which
+
+    * does nothing once figures are turned off (disable)
+    * draws in a pool of background processes once started
+      (start_renderer), so the numeric pipeline does not wait
+      for them, join waits for the figures drawn so far
+    * otherwise draws on the calling thread
+"""
+import multiprocessing
+
+# processes drawing figures, see start_renderer
+RENDER_PROCESSES = 1
+
+_state = {'enabled': True, 'pool': None, 'pending': []}
+
+
+def enable():
+    """turns figures on"""
+    _state['enabled'] = True
+
+
+def disable():
+    """turns figures off, render does nothing"""
+    _state['enabled'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def start_renderer(nprocs=RENDER_PROCESSES):
+    """ draws figures passed to render in a pool of nprocs
+    background processes, start it before loading large data
+    so the (forked) workers stay small"""
+    if _state['pool'] is None:
+        _state['pool'] = multiprocessing.Pool(nprocs)
+
+
+def join():
+    """ waits for figures being drawn in the background, raises
+    the first error of any of them"""
+    pending, _state['pending'] = _state['pending'], []
+    for result in pending:
+        result.wait()
+    for result in pending:
+        result.get()
+
+
+def stop_renderer():
+    """ joins and stops the background processes, later figures are
+    drawn on the calling thread"""
+    pool = _state['pool']
+    try:
+        join()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            _state['pool'] = None
+
+
+def render(draw, *args, **kwargs):
+    """ calls draw(*args, **kwargs) (eg input_plot) in the background
+    renderer if started, or now, returns False if figures are off"""
+    if not _state['enabled']:
+        return False
+    if _state['pool'] is not None:
+        _state['pending'].append(_state['pool'].apply_async(draw, args,
+                                                            kwargs))
+    else:
+        draw(*args, **kwargs)
+    return True
+
+
+def new_figure(label=None):
+    """ Figure attached to an Agg canvas, imports matplotlib"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    if label is not None:
+        fig.set_label(label)
+    return fig
+
+
+def input_plot(ref, midframes, figname):
+    """ draws reference TAC against midframe times (sec) to
+    png figname"""
+    fig = new_figure('Reference TAC')
+    ax1 = fig.add_subplot(111)
+    ax1.plot(midframes,ref, 'ko-')
+    ax2 = ax1.twiny()
+    ax1.set_xlabel('midframe times (sec)')
+    ax1.set_ylabel('counts bq/ml')
+    ax2.set_xlabel('midframe times (min)')
+    xticks_minutes = (ax1.get_xticks() / 60.).round()
+    ax2.set_xticks(xticks_minutes)
+    ax1.grid()
+    fig.savefig(figname, format='png')
+    return figname
+
+
+def logan_plot(rx, ry, refx, refy, fit, reffit, figname):
+    """ draws Logan plot of region (rx, ry) and reference (refx, refy)
+    with fitted lines, fit and reffit are (slope, intercept), to
+    png figname"""
+    slope, intercept = fit
+    refslope, refintercept = reffit
+    fig = new_figure('Logan Plot')
+    ax1 = fig.add_subplot(111)
+    ax1.plot(rx, ry, 'ro', label = 'pibindex')
+    ax1.plot(refx, refy, 'bo', label = 'ref region')
+    ax1.plot(rx, rx * slope + intercept, 'k-',
+             label = 'region slope : %2.2f'%slope)
+    ax1.plot(refx, refx * refslope + refintercept, 'b-',
+             label='ref slope : %2.2f'%refslope)
+    ax1.legend(loc='lower right')
+    ax1.set_ylabel('$\int data / data$')
+    ax1.set_xlabel('$(\int ref / data) + (1 / k2rf) * ref / data$')
+    fig.savefig(figname, format='png')
+    return figname
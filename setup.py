@@ -12,6 +12,6 @@ setup(
     description='Tools for Graphical Analysis of PET data',
     long_description=open('README.txt').read(),
     install_requires=[
-        "numpy >= 1.6.1",
+        "numpy >= 1.13",
         ],
 )